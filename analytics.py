@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module is the read side of the sparkify database. It runs the
+standard reports over the star schema (top songs and artists, plays by hour
+of day and by weekday, active users by level) through a connection pool
+shared by its callers, and keeps their results in memory so repeated
+dashboard hits don't go back to the database.
+
+Cached results are keyed by report and parameters and are valid for one
+load version. The etl bumps the version in the same transaction as every
+batch of rows it commits, and the version is re-read at most every
+check_seconds, so a cached result is never older than the last load by
+more than that.
+
+Dependencies: The tables must be created by the create_tables module, and
+loaded by the etl module for the reports to return anything.
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import time
+import argparse
+import calendar
+import datetime
+import threading
+import psycopg2.pool
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from backends import SPARKIFY_DSN
+from sql_queries import top_songs_select, top_artists_select
+from sql_queries import plays_by_hour_select, plays_by_weekday_select
+from sql_queries import active_users_select, load_version_select
+
+# report name -> (query, parameters and their defaults)
+REPORTS = OrderedDict([
+    ('top_songs', (top_songs_select,
+                   {'start': None, 'end': None, 'limit': 10})),
+    ('top_artists', (top_artists_select,
+                     {'start': None, 'end': None, 'limit': 10})),
+    ('plays_by_hour', (plays_by_hour_select, {'start': None, 'end': None})),
+    ('plays_by_weekday', (plays_by_weekday_select,
+                          {'start': None, 'end': None})),
+    ('active_users', (active_users_select, {'start': None, 'end': None}))])
+
+CACHE_ENTRIES = 256
+VERSION_CHECK_SECONDS = 5.0
+
+# result of a report call, seconds being the latency seen by the caller
+Report = namedtuple('Report', ['name', 'columns', 'rows', 'cached',
+                               'seconds'])
+
+
+def to_epoch_ms(value):
+    """Returns a period bound as epoch ms, the unit of start_time.
+
+    Keyword arguments:
+    value - None, int epoch ms, a 'YYYY-MM-DD' string or a date or naive
+            datetime in UTC
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = datetime.datetime.strptime(value, '%Y-%m-%d')
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+
+    return (calendar.timegm(value.utctimetuple()) * 1000 +
+            value.microsecond // 1000)
+
+
+class Analytics(object):
+    """Runs the REPORTS over a shared connection pool and caches their
+    results, least recently used first out, until the load version
+    changes. Instances are safe to share between threads.
+    """
+
+    def __init__(self, dsn=SPARKIFY_DSN, pool=None, maxconn=4,
+                 max_entries=CACHE_ENTRIES,
+                 check_seconds=VERSION_CHECK_SECONDS):
+        """Keyword arguments:
+        dsn - str, connection string of the sparkify database
+        pool - psycopg2.pool.AbstractConnectionPool to share with other
+               code, a threaded pool of up to maxconn connections to dsn is
+               created when None
+        maxconn - int, maximum number of connections of the created pool
+        max_entries - int, maximum number of cached results
+        check_seconds - float, how long the load version read last is
+                        trusted before it is read again
+        """
+        if pool is None:
+            pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, dsn)
+        self.pool = pool
+        self.max_entries = max_entries
+        self.check_seconds = check_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = None
+
+    @contextmanager
+    def _cursor(self):
+        conn = self.pool.getconn()
+        autocommit = conn.autocommit
+        try:
+            # reports only read, no transaction is left open between them.
+            # The pool may be shared, its connections go back as they came
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                yield cur
+        finally:
+            conn.autocommit = autocommit
+            self.pool.putconn(conn)
+
+    def load_version(self):
+        """Returns the load version, reading it from the database when it
+        was last read more than check_seconds ago. The cache is cleared
+        when the version changed.
+        """
+        with self._lock:
+            if (self._checked_at is not None and
+                    time.time() - self._checked_at < self.check_seconds):
+                return self._version
+
+        with self._cursor() as cur:
+            cur.execute(load_version_select)
+            version = cur.fetchone()
+
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._checked_at = time.time()
+            return version
+
+    def invalidate(self):
+        """Drops every cached result and forces the next call to read the
+        load version."""
+        with self._lock:
+            self._entries.clear()
+            self._checked_at = None
+
+    def run(self, name, **params):
+        """Runs a report, answering from the cache when it holds a result
+        for the same parameters and load version.
+
+        Keyword arguments:
+        name - str, name of the report, a key of REPORTS
+        params - parameters of the report, start and end bounds of the
+                 period are converted with to_epoch_ms
+
+        Returns a Report holding the rows and the latency of the call.
+        """
+        start = time.time()
+        query, defaults = REPORTS[name]
+        unknown = set(params) - set(defaults)
+        if unknown:
+            raise TypeError('Unknown parameters of {}: {}'.format(
+                name, ', '.join(sorted(unknown))))
+        values = dict(defaults, **params)
+        values['start'] = to_epoch_ms(values['start'])
+        values['end'] = to_epoch_ms(values['end'])
+        key = (name, tuple(sorted(values.items())))
+
+        version = self.load_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return Report(name, entry[1], entry[2], True,
+                              time.time() - start)
+
+        with self._cursor() as cur:
+            cur.execute(query, values)
+            columns = [column[0] for column in cur.description]
+            rows = cur.fetchall()
+
+        # a load that committed meanwhile shows in the next version read,
+        # which then misses this entry
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (version, columns, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return Report(name, columns, rows, False, time.time() - start)
+
+    def top_songs(self, start=None, end=None, limit=10):
+        """Most played songs of a period, with their artist."""
+        return self.run('top_songs', start=start, end=end, limit=limit)
+
+    def top_artists(self, start=None, end=None, limit=10):
+        """Most played artists of a period."""
+        return self.run('top_artists', start=start, end=end, limit=limit)
+
+    def plays_by_hour(self, start=None, end=None):
+        """Plays per hour of the day (UTC) over a period."""
+        return self.run('plays_by_hour', start=start, end=end)
+
+    def plays_by_weekday(self, start=None, end=None):
+        """Plays per weekday (Monday = 0) over a period."""
+        return self.run('plays_by_weekday', start=start, end=end)
+
+    def active_users(self, start=None, end=None):
+        """Distinct users and plays per level over a period."""
+        return self.run('active_users', start=start, end=end)
+
+    def close(self):
+        """Closes the connections of the pool."""
+        self.pool.closeall()
+
+
+def main():
+    """Entry point to this module. Runs a report and prints its rows and
+    the latency of each call."""
+    parser = argparse.ArgumentParser(
+        description='Run a standard report over the sparkify database')
+    parser.add_argument('report', choices=list(REPORTS))
+    parser.add_argument('--start', metavar='YYYY-MM-DD',
+                        help='first day of the period (UTC)')
+    parser.add_argument('--end', metavar='YYYY-MM-DD',
+                        help='day after the period (UTC)')
+    parser.add_argument('--limit', type=int, default=10,
+                        help='number of rows of the top songs and artists '
+                             'reports (default 10)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of times the report is run, repeated '
+                             'calls are answered from the cache')
+    args = parser.parse_args()
+
+    params = {'start': args.start, 'end': args.end}
+    if 'limit' in REPORTS[args.report][1]:
+        params['limit'] = args.limit
+
+    analytics = Analytics(maxconn=1)
+    try:
+        for i in range(args.repeat):
+            report = analytics.run(args.report, **params)
+            if i == 0:
+                print('\t'.join(report.columns))
+                for row in report.rows:
+                    print('\t'.join(str(value) for value in row))
+            print('{} in {:.2f}ms{}'.format(
+                report.name, report.seconds * 1000,
+                ' (cached)' if report.cached else ''))
+    finally:
+        analytics.close()
+
+
+if __name__ == "__main__":
+    main()
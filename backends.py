@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""This module is used as an import for the etl, create_tables, benchmark and
+tests modules. It holds the connection settings of the sparkify database and
+the backends the etl can load into: the Postgres database, and an embedded
+DuckDB file for fast local runs without a database server. Each backend can
+connect, create the tables and load the song and log trees.
+
+Dependencies: psycopg2 for the Postgres backend, duckdb (optional) for the
+DuckDB backend.
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import psycopg2
+from metrics import CountingCursor
+from sql_queries import *
+
+POSTGRES_DSN = "host=127.0.0.1 dbname={} user=student password=student"
+STUDENT_DSN = POSTGRES_DSN.format('studentdb')
+SPARKIFY_DSN = POSTGRES_DSN.format('sparkifydb')
+
+DUCKDB_PATH = 'sparkify.duckdb'
+
+
+class PostgresBackend(object):
+    """Loads the sparkify Postgres database through the etl module's song and
+    log passes."""
+
+    name = 'postgres'
+
+    def __init__(self, dsn=SPARKIFY_DSN):
+        """Keyword arguments:
+        dsn - str, connection string of the database to load
+        """
+        self.dsn = dsn
+
+    def connect(self):
+        """Returns a new connection whose cursors count their statements."""
+        return psycopg2.connect(self.dsn, cursor_factory=CountingCursor)
+
+    def create_tables(self, conn):
+        """Creates any missing tables. The create_tables module resets the
+        database instead.
+
+        Keyword arguments:
+        conn - open connection to the database
+        """
+        cur = conn.cursor()
+        for query in create_table_queries:
+            cur.execute(query)
+        conn.commit()
+
+    def load(self, conn, args, song_path, log_path):
+        """Loads the song files and then the log files.
+
+        Keyword arguments:
+        conn - open connection to the database
+        args - argparse.Namespace holding the options of the etl
+        song_path - directory string of the song files
+        log_path - directory string of the log files
+
+        Returns the SongCache used to resolve songplays, or None.
+        """
+        self.load_songs(conn, args, song_path)
+        return self.load_logs(conn, args, log_path)
+
+    def load_songs(self, conn, args, song_path):
+        """Runs the song pass of the etl.
+
+        Keyword arguments:
+        conn - open connection to the database
+        args - argparse.Namespace holding the options of the etl
+        song_path - directory string of the song files
+        """
+        # imported here since the etl module imports this one
+        import etl
+        etl.run_song_pass(conn.cursor(), conn, args, filepath=song_path,
+                          dsn=self.dsn)
+
+    def load_logs(self, conn, args, log_path):
+        """Runs the log pass of the etl.
+
+        Keyword arguments:
+        conn - open connection to the database
+        args - argparse.Namespace holding the options of the etl
+        log_path - directory string of the log files
+
+        Returns the SongCache used to resolve songplays, or None.
+        """
+        import etl
+        return etl.run_log_pass(conn.cursor(), conn, args,
+                                filepath=log_path, dsn=self.dsn)
+
+
+class DuckDBBackend(object):
+    """Loads the star schema into an embedded DuckDB file, reading the json
+    trees directly with one set-based statement per table. The etl options
+    that tune the Postgres load (bulk, workers, batches...) don't apply."""
+
+    name = 'duckdb'
+
+    def __init__(self, path=DUCKDB_PATH):
+        """Keyword arguments:
+        path - str, location of the DuckDB database file
+        """
+        self.path = path
+
+    def connect(self):
+        """Returns a connection to the DuckDB file, creating it if needed."""
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError('The duckdb backend needs the duckdb package, '
+                              'install it with: pip install duckdb')
+        return duckdb.connect(self.path)
+
+    def create_tables(self, conn):
+        """Creates any missing tables.
+
+        Keyword arguments:
+        conn - open connection to the DuckDB file
+        """
+        for query in duckdb_table_queries:
+            conn.execute(query)
+
+    def load(self, conn, args, song_path, log_path):
+        """Loads the song files and then the log files.
+
+        Keyword arguments:
+        conn - open connection to the DuckDB file
+        args - argparse.Namespace holding the options of the etl
+        song_path - directory string of the song files
+        log_path - directory string of the log files
+        """
+        self.load_songs(conn, args, song_path)
+        return self.load_logs(conn, args, log_path)
+
+    def load_songs(self, conn, args, song_path):
+        """Loads the songs and artists tables from the song files.
+
+        Keyword arguments:
+        conn - open connection to the DuckDB file
+        args - argparse.Namespace holding the options of the etl
+        song_path - directory string of the song files
+        """
+        self.create_tables(conn)
+
+        songs = duckdb_song_source.format(path=song_path)
+        conn.execute(duckdb_song_load.format(source=songs))
+        conn.execute(duckdb_artist_load.format(source=songs))
+        conn.commit()
+
+    def load_logs(self, conn, args, log_path):
+        """Loads the time, users and songplays tables from the log files.
+
+        Keyword arguments:
+        conn - open connection to the DuckDB file
+        args - argparse.Namespace holding the options of the etl
+        log_path - directory string of the log files
+        """
+        self.create_tables(conn)
+
+        events = duckdb_log_source.format(path=log_path)
+        conn.execute(duckdb_event_view.format(source=events))
+        conn.execute(duckdb_time_load)
+        conn.execute(duckdb_user_load)
+        conn.execute(duckdb_songplay_load)
+
+        # the set-based load rebuilds the rollups instead of merging them
+        for table in rollup_tables:
+            conn.execute(rollup_truncate.format(table=table))
+        for query in rollup_refresh_queries:
+            conn.execute(query)
+        conn.commit()
+
+
+def get_backend(name, dsn=SPARKIFY_DSN, path=DUCKDB_PATH):
+    """Returns the backend called name.
+
+    Keyword arguments:
+    name - str, 'postgres' or 'duckdb'
+    dsn - str, connection string of the Postgres database
+    path - str, location of the DuckDB database file
+    """
+    if name == 'duckdb':
+        return DuckDBBackend(path)
+    return PostgresBackend(dsn)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module benchmarks the etl module. It generates synthetic song_data and
+log_data trees with the same schemas as the sample data, loads them into a
+throwaway database and reports throughput, database round-trips, peak memory
+and per-stage wall time. Results are appended to a JSON file so that runs can
+be compared across commits.
+
+Dependencies: A local Postgres instance with the studentdb database (see the
+create_tables module). The benchmark database is dropped and recreated on
+every run. With --backend duckdb the data is loaded into a DuckDB file in the
+data directory instead.
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import os
+import json
+import time
+import random
+import string
+import argparse
+import calendar
+import datetime
+import resource
+import subprocess
+import psycopg2
+import etl
+import metrics
+import parquet_stage
+from metrics import CountingCursor
+from create_tables import create_tables, create_indexes
+from backends import POSTGRES_DSN, STUDENT_DSN, get_backend
+
+BENCH_DB = "sparkifybench"
+BENCH_DSN = POSTGRES_DSN.format(BENCH_DB)
+
+# pages of the non NextSong events and how often they occur
+OTHER_PAGES = ['Home', 'Logout', 'Login', 'Settings', 'Help', 'About',
+               'Upgrade', 'Downgrade', 'Save Settings', 'Error']
+NEXT_SONG_RATE = 0.8
+
+USER_AGENTS = [
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like '
+    'Gecko) Chrome/35.0.1916.153 Safari/537.36"',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA',
+             'Phoenix-Mesa-Scottsdale, AZ',
+             'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI',
+             'New York-Newark-Jersey City, NY-NJ-PA']
+
+
+def random_word(rng, length):
+    """Returns a capitalized random word of the given length."""
+    return ''.join(rng.choice(string.ascii_lowercase)
+                   for _ in range(length)).capitalize()
+
+
+def random_id(rng, prefix, length=16):
+    """Returns a random id in the style of the million song dataset."""
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits)
+                            for _ in range(length))
+
+
+def generate_songs(song_dir, num_songs, rng):
+    """Writes one song file per song under song_dir, laid out like the sample
+    data as song_data/<3rd>/<4th>/<5th character of track id>/<track id>.json
+
+    Keyword arguments:
+    song_dir - str, root directory of the song files
+    num_songs - int, number of song files to write
+    rng - random.Random used to generate the data
+
+    Returns a list of (title, artist name, duration) of the songs written.
+    """
+    num_artists = max(1, num_songs // 4)
+    artists = []
+    for _ in range(num_artists):
+        coords = rng.random() < 0.5
+        artists.append({
+            'artist_id': random_id(rng, 'AR'),
+            'artist_name': random_word(rng, 8),
+            'artist_location': rng.choice(LOCATIONS + ['']),
+            'artist_latitude': rng.uniform(-90, 90) if coords else None,
+            'artist_longitude': rng.uniform(-180, 180) if coords else None})
+
+    songs = []
+    for _ in range(num_songs):
+        artist = rng.choice(artists)
+        track_id = ('TR' + rng.choice('AB') + rng.choice('ABC') +
+                    random_id(rng, '', 14))
+        record = {
+            'num_songs': 1,
+            'song_id': random_id(rng, 'SO'),
+            'title': ' '.join(random_word(rng, 6)
+                              for _ in range(rng.randint(1, 3))),
+            'duration': round(rng.uniform(60, 600), 5),
+            'year': rng.choice([0] + list(range(1960, 2019)))}
+        record.update(artist)
+
+        path = os.path.join(song_dir, *track_id[2:5])
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, track_id + '.json'), 'w') as f:
+            json.dump(record, f)
+        songs.append((record['title'], record['artist_name'],
+                      record['duration']))
+
+    return songs
+
+
+def generate_logs(log_dir, num_events, songs, rng, days=30, num_users=100,
+                  start=datetime.date(2018, 11, 1)):
+    """Writes one newline delimited events file per day under log_dir, laid
+    out like the sample data as log_data/<year>/<month>/<date>-events.json
+
+    Keyword arguments:
+    log_dir - str, root directory of the log files
+    num_events - int, total number of events to write
+    songs - list of (title, artist name, duration) the NextSong events play
+    rng - random.Random used to generate the data
+    days - int, number of daily files the events are spread over
+    num_users - int, number of distinct users
+
+    Returns a tuple of the number of files and NextSong events written.
+    """
+    users = [{'userId': str(i),
+              'firstName': random_word(rng, 6),
+              'lastName': random_word(rng, 7),
+              'gender': rng.choice('MF'),
+              'level': rng.choice(['free', 'paid']),
+              'location': rng.choice(LOCATIONS),
+              'userAgent': rng.choice(USER_AGENTS),
+              'registration': 1540000000000.0 + rng.randint(0, 10 ** 9)}
+             for i in range(1, num_users + 1)]
+
+    next_songs = 0
+    per_day = -(-num_events // days)
+    for day in range(days):
+        date = start + datetime.timedelta(days=day)
+        day_ms = calendar.timegm(date.timetuple()) * 1000
+        path = os.path.join(log_dir, str(date.year),
+                            '{:02d}'.format(date.month))
+        os.makedirs(path, exist_ok=True)
+
+        count = min(per_day, num_events - day * per_day)
+        with open(os.path.join(path, '{}-events.json'.format(date)), 'w') as f:
+            for i in range(max(count, 0)):
+                user = rng.choice(users)
+                event = dict(user)
+                event.update({
+                    'auth': 'Logged In',
+                    'itemInSession': rng.randint(0, 100),
+                    'method': 'PUT',
+                    'page': 'NextSong',
+                    'sessionId': rng.randint(1, 1000),
+                    'status': 200,
+                    'ts': day_ms + i * (86400000 // max(count, 1))})
+
+                if rng.random() < NEXT_SONG_RATE:
+                    title, artist, length = rng.choice(songs)
+                    event.update({'song': title, 'artist': artist,
+                                  'length': length})
+                    next_songs += 1
+                else:
+                    event.update({'song': None, 'artist': None,
+                                  'length': None, 'method': 'GET',
+                                  'page': rng.choice(OTHER_PAGES)})
+
+                f.write(json.dumps(event) + '\n')
+
+    return days, next_songs
+
+
+def generate_data(data_dir, num_events, num_songs, seed=0, days=30):
+    """Generates a synthetic data tree holding song_data and log_data.
+
+    Keyword arguments:
+    data_dir - str, directory to write the trees into
+    num_events - int, total number of log events
+    num_songs - int, number of song files
+    seed - int, seed of the random generator so runs are reproducible
+    days - int, number of daily log files
+
+    Returns a dict describing the generated data.
+    """
+    rng = random.Random(seed)
+    songs = generate_songs(os.path.join(data_dir, 'song_data'), num_songs, rng)
+    log_files, next_songs = generate_logs(os.path.join(data_dir, 'log_data'),
+                                          num_events, songs, rng, days=days)
+
+    return {'song_files': num_songs, 'log_files': log_files,
+            'events': num_events, 'next_song_events': next_songs}
+
+
+def create_bench_database():
+    """Drops and recreates the benchmark database with the sparkify tables.
+
+    Returns an open connection to the new database.
+    """
+    conn = psycopg2.connect(STUDENT_DSN)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute("DROP DATABASE IF EXISTS {}".format(BENCH_DB))
+    cur.execute("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0"
+                .format(BENCH_DB))
+    conn.close()
+
+    conn = psycopg2.connect(BENCH_DSN, cursor_factory=CountingCursor)
+    create_tables(conn.cursor(), conn)
+    create_indexes(conn.cursor(), conn)
+    return conn
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size in MB of this process and of the
+    worker processes it waited for."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024.0
+
+
+def git_commit():
+    """Returns the commit the benchmark is run from, if known."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(args):
+    """Generates the data set, loads it with the etl options in args and
+    returns the measurements as a dict.
+
+    Keyword arguments:
+    args - argparse.Namespace of the benchmark and etl options
+    """
+    stages = {}
+    metrics.configure(args.metrics)
+
+    start = time.time()
+    data = generate_data(args.data_dir, args.events, args.songs,
+                         seed=args.seed, days=args.days)
+    stages['generate'] = time.time() - start
+
+    song_path = os.path.join(args.data_dir, 'song_data')
+    log_path = os.path.join(args.data_dir, 'log_data')
+    if args.parquet:
+        start = time.time()
+        song_path, log_path = parquet_stage.stage_data(
+            song_path, log_path, os.path.join(args.data_dir, 'parquet'))
+        stages['parquet_stage'] = time.time() - start
+
+    if args.backend == 'duckdb':
+        backend = get_backend('duckdb', path=os.path.join(
+            args.data_dir, BENCH_DB + '.duckdb'))
+        conn = backend.connect()
+    else:
+        backend = get_backend('postgres', dsn=BENCH_DSN)
+        conn = create_bench_database()
+    CountingCursor.round_trips = 0
+
+    start = time.time()
+    backend.load_songs(conn, args, song_path)
+    stages['song_pass'] = time.time() - start
+
+    start = time.time()
+    backend.load_logs(conn, args, log_path)
+    stages['log_pass'] = time.time() - start
+
+    cur = conn.cursor()
+    cur.execute('SELECT count(*) FROM songplays')
+    songplays = cur.fetchone()[0]
+    conn.close()
+
+    load_time = stages['song_pass'] + stages['log_pass']
+    options = {k: v for k, v in vars(args).items()
+               if k not in ('output', 'data_dir')}
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'options': options,
+        'data': data,
+        'songplays_loaded': songplays,
+        'stage_seconds': stages,
+        'song_files_per_sec': data['song_files'] / stages['song_pass'],
+        'events_per_sec': data['events'] / stages['log_pass'],
+        'files_per_sec': (data['song_files'] + data['log_files']) / load_time,
+        # statements of worker processes and of duckdb are not counted
+        'db_round_trips': (CountingCursor.round_trips
+                           if args.workers == 1 and
+                           args.backend == 'postgres' else None),
+        'peak_rss_mb': peak_rss_mb()}
+
+
+def main():
+    """Entry point to this benchmark module. Accepts the options of the etl
+    module on top of its own.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sparkify etl',
+        parents=[etl.build_arg_parser(add_help=False)])
+    parser.add_argument('--events', type=int, default=10000,
+                        help='number of log events to generate')
+    parser.add_argument('--songs', type=int, default=1000,
+                        help='number of song files to generate')
+    parser.add_argument('--days', type=int, default=30,
+                        help='number of daily log files to spread events over')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic data generator')
+    parser.add_argument('--data-dir', default='bench_data',
+                        help='directory to generate the data trees into')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file the results are appended to')
+    args = parser.parse_args()
+
+    if os.path.exists(args.data_dir) and os.listdir(args.data_dir):
+        parser.error('{} is not empty'.format(args.data_dir))
+    etl.check_args(parser, args)
+
+    result = run_benchmark(args)
+    print(json.dumps(result, indent=2))
+
+    results = []
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            results = json.load(f)
+    results.append(result)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,8 +13,28 @@ __maintainer__ = "Tim Fenton"
 __email__ = "tfenton@gmail.com"
 __status__ = "Production"
 
+import time
+import argparse
 import psycopg2
+import etl
+from backends import STUDENT_DSN, SPARKIFY_DSN, get_backend
 from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_index_queries, create_partitioned_table_queries
+from sql_queries import partitioned_tables, partition_detach
+from sql_queries import rollup_tables, rollup_truncate, rollup_refresh_queries
+from sql_queries import drop_index_queries
+from sql_queries import schema_exists, schema_create, schema_grant
+from sql_queries import schema_rename, schema_drop, schema_tables_select
+from sql_queries import schema_tables_truncate, table_analyze
+from sql_queries import songplay_sequence_restart, load_version_bump
+
+# a reload builds the staging schema and swaps it with the live one, which
+# is kept as the previous schema and becomes the next run's staging schema
+LIVE_SCHEMA = 'public'
+STAGING_SCHEMA = 'sparkify_staging'
+PREVIOUS_SCHEMA = 'sparkify_previous'
+STAGING_DSN = SPARKIFY_DSN + " options='-c search_path={}'".format(
+    STAGING_SCHEMA)
 
 
 def create_database():
@@ -23,8 +43,7 @@ def create_database():
     '''
     # connect to default database
     try:
-        conn = psycopg2.connect(
-            "host=127.0.0.1 dbname=studentdb user=student password=student")
+        conn = psycopg2.connect(STUDENT_DSN)
         conn.set_session(autocommit=True)
         cur = conn.cursor()
     except Exception as e:
@@ -43,8 +62,7 @@ def create_database():
 
     # connect to sparkify database
     try:
-        conn = psycopg2.connect(
-            "host=127.0.0.1 dbname=sparkifydb user=student password=student")
+        conn = psycopg2.connect(SPARKIFY_DSN)
         cur = conn.cursor()
     except Exception as e:
         print(e)
@@ -68,15 +86,19 @@ def drop_tables(cur, conn):
             print(query, e)
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, partitioned=False):
     """Create all tables via the queries stored in the 'create_table_queries'
     list that is imported from sql_queries module.
 
     Keyword arguments:
     cur - open cursor to the sparkify database
     conn - open connection to the sparkify database
+    partitioned - bool, create songplays and time range partitioned by month
+                  using the 'create_partitioned_table_queries' list instead
     """
-    for query in create_table_queries:
+    queries = (create_partitioned_table_queries if partitioned
+               else create_table_queries)
+    for query in queries:
         try:
             cur.execute(query)
             conn.commit()
@@ -84,14 +106,244 @@ def create_tables(cur, conn):
             print(query, e)
 
 
+def create_indexes(cur, conn):
+    """Create the lookup and analytic indexes via the queries stored in the
+    'create_index_queries' list that is imported from sql_queries module.
+
+    Keyword arguments:
+    cur - open cursor to the sparkify database
+    conn - open connection to the sparkify database
+    """
+    for query in create_index_queries:
+        try:
+            cur.execute(query)
+            conn.commit()
+        except Exception as e:
+            print(query, e)
+
+
+def detach_month(cur, conn, month):
+    """Detach the partitions of a month from the partitioned tables. The
+    partitions are kept as standalone tables that can be archived or dropped.
+
+    Keyword arguments:
+    cur - open cursor to the sparkify database
+    conn - open connection to the sparkify database
+    month - str, month of the partitions in YYYY-MM format
+    """
+    year, month = (int(part) for part in month.split('-'))
+    for table in partitioned_tables:
+        partition = '{}_y{:04d}m{:02d}'.format(table, year, month)
+        try:
+            cur.execute(partition_detach.format(table=table,
+                                                partition=partition))
+            conn.commit()
+            print('Detached {}'.format(partition))
+        except Exception as e:
+            conn.rollback()
+            print(partition, e)
+
+
+def refresh_rollups(cur, conn):
+    """Rebuild the rollup tables from the whole songplays table in a single
+    transaction, so readers see either the old or the new summaries.
+
+    Keyword arguments:
+    cur - open cursor to the sparkify database
+    conn - open connection to the sparkify database
+    """
+    try:
+        for table in rollup_tables:
+            cur.execute(rollup_truncate.format(table=table))
+        for query in rollup_refresh_queries:
+            cur.execute(query)
+        cur.execute(load_version_bump)
+        conn.commit()
+        print('Refreshed {}'.format(', '.join(rollup_tables)))
+    except Exception as e:
+        conn.rollback()
+        print('Error when refreshing the rollup tables')
+        print(e)
+
+
+def has_schema(cur, schema):
+    """Returns whether a schema exists in the sparkify database.
+
+    Keyword arguments:
+    cur - open cursor to the sparkify database
+    schema - str, name of the schema
+    """
+    cur.execute(schema_exists, (schema,))
+    return cur.fetchone()[0]
+
+
+def prepare_staging_schema(cur, conn, staging_cur, staging_conn,
+                           partitioned=False):
+    """Readies an empty staging schema for a reload. The schema left by the
+    previous swap is reused, truncating its tables instead of recreating
+    them, unless its songplays table is partitioned differently.
+
+    Keyword arguments:
+    cur - open cursor to the sparkify database
+    conn - open connection to the sparkify database
+    staging_cur - open cursor whose search_path is the staging schema
+    staging_conn - open connection whose search_path is the staging schema
+    partitioned - bool, create songplays and time range partitioned by month
+    """
+    if (not has_schema(cur, STAGING_SCHEMA) and
+            has_schema(cur, PREVIOUS_SCHEMA)):
+        cur.execute(schema_rename.format(schema=PREVIOUS_SCHEMA,
+                                         name=STAGING_SCHEMA))
+    conn.commit()
+
+    if etl.is_partitioned(staging_cur, staging_conn,
+                          'songplays') != partitioned:
+        staging_cur.execute(schema_drop.format(schema=STAGING_SCHEMA))
+    staging_cur.execute(schema_create.format(schema=STAGING_SCHEMA))
+    staging_cur.execute(schema_grant.format(schema=STAGING_SCHEMA))
+    staging_conn.commit()
+
+    # create whatever is missing, then empty the tables
+    create_tables(staging_cur, staging_conn, partitioned=partitioned)
+    staging_cur.execute(schema_tables_select, (STAGING_SCHEMA,))
+    tables = [table for table, in staging_cur.fetchall()]
+    staging_cur.execute(schema_tables_truncate.format(tables=', '.join(
+        '{}.{}'.format(STAGING_SCHEMA, table) for table in tables)))
+    staging_cur.execute(songplay_sequence_restart)
+
+    # indexes are built once the tables are loaded
+    for query in drop_index_queries:
+        staging_cur.execute(query)
+    staging_conn.commit()
+
+
+def analyze_schema(cur, conn, schema):
+    """Collects planner statistics of every table of a schema.
+
+    Keyword arguments:
+    cur - open cursor to the sparkify database
+    conn - open connection to the sparkify database
+    schema - str, name of the schema
+    """
+    cur.execute(schema_tables_select, (schema,))
+    for table, in cur.fetchall():
+        cur.execute(table_analyze.format(schema=schema, table=table))
+    conn.commit()
+
+
+def swap_schemas(cur, conn):
+    """Makes the staging schema live in a single transaction. The live
+    schema is kept as the previous one, readers see the old tables until the
+    transaction commits and the new ones after.
+
+    Keyword arguments:
+    cur - open cursor to the sparkify database
+    conn - open connection to the sparkify database
+    """
+    try:
+        cur.execute(schema_drop.format(schema=PREVIOUS_SCHEMA))
+        cur.execute(schema_rename.format(schema=LIVE_SCHEMA,
+                                         name=PREVIOUS_SCHEMA))
+        cur.execute(schema_rename.format(schema=STAGING_SCHEMA,
+                                         name=LIVE_SCHEMA))
+        cur.execute(load_version_bump)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        print('Error when swapping the staging and live schemas')
+        raise
+
+
+def reload(args):
+    """Reloads the sparkify database without downtime for readers. The etl
+    loads the staging schema, its indexes are built and its tables analyzed
+    and it is then swapped with the live schema.
+
+    Keyword arguments:
+    args - argparse.Namespace holding the etl options and --partitioned
+    """
+    try:
+        conn = psycopg2.connect(SPARKIFY_DSN)
+        cur = conn.cursor()
+    except Exception as e:
+        print(e)
+        print('Creating the sparkify database')
+        cur, conn = create_database()
+
+    start = time.time()
+    staging_conn = get_backend('postgres', dsn=STAGING_DSN).connect()
+    staging_cur = staging_conn.cursor()
+    prepare_staging_schema(cur, conn, staging_cur, staging_conn,
+                           partitioned=args.partitioned)
+    print('Prepared {} in {:.2f}s'.format(STAGING_SCHEMA,
+                                          time.time() - start))
+
+    # the indexes were dropped and are built once after the load
+    args.defer_indexes = False
+    backend = get_backend('postgres', dsn=STAGING_DSN)
+    backend.load(staging_conn, args, *etl.source_paths(args))
+
+    start = time.time()
+    create_indexes(staging_cur, staging_conn)
+    analyze_schema(staging_cur, staging_conn, STAGING_SCHEMA)
+    staging_conn.close()
+    print('Indexed and analyzed {} in {:.2f}s'.format(STAGING_SCHEMA,
+                                                       time.time() - start))
+
+    swap_schemas(cur, conn)
+    print('Swapped {} live, the old tables are kept in {}'.format(
+        STAGING_SCHEMA, PREVIOUS_SCHEMA))
+    conn.close()
+
+
 def main():
     """Create the sparkify database, drop any tables currently in it,
-    and then recreate those tables.
+    and then recreate those tables and their indexes.
     """
+    parser = argparse.ArgumentParser(
+        description='Create the sparkify database',
+        parents=[etl.build_arg_parser(add_help=False)])
+    parser.add_argument('--partitioned', action='store_true',
+                        help='range partition songplays and time by month '
+                             '(requires Postgres 11 or later)')
+    parser.add_argument('--detach-month', metavar='YYYY-MM',
+                        help='only detach the partitions of a month from the '
+                             'existing sparkify database')
+    parser.add_argument('--refresh-rollups', action='store_true',
+                        help='only rebuild the rollup tables of the existing '
+                             'sparkify database from songplays')
+    parser.add_argument('--reload', action='store_true',
+                        help='load the data into a staging schema with the '
+                             'etl options and swap it with the live one, '
+                             'instead of recreating the database')
+    args = parser.parse_args()
+    etl.check_args(parser, args)
+    # the etl creates the tables of the duckdb backend itself
+    if args.backend != 'postgres':
+        parser.error('create_tables.py only applies to the postgres backend, '
+                     'etl.py --backend duckdb creates its own tables')
+
+    if args.reload:
+        reload(args)
+        return
+
+    if args.refresh_rollups:
+        conn = psycopg2.connect(SPARKIFY_DSN)
+        refresh_rollups(conn.cursor(), conn)
+        conn.close()
+        return
+
+    if args.detach_month:
+        conn = psycopg2.connect(SPARKIFY_DSN)
+        detach_month(conn.cursor(), conn, args.detach_month)
+        conn.close()
+        return
+
     cur, conn = create_database()
 
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, partitioned=args.partitioned)
+    create_indexes(cur, conn)
 
     conn.close()
 
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""This module is used as an import for the etl and parquet_stage modules. It
+finds the data files of a tree with a single os.scandir traversal, yielding
+them lazily so loading can start as soon as the first files are found.
+Hidden directories (e.g. the .ipynb_checkpoints copies of song files) and
+notebook checkpoint files are skipped by default.
+
+Dependencies: None
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import os
+import itertools
+import readers
+from fnmatch import fnmatch
+
+# file name patterns picked up and skipped when none are given
+DEFAULT_INCLUDE = readers.JSON_PATTERNS
+DEFAULT_EXCLUDE = ('*-checkpoint.*',)
+
+
+def matches(name, patterns):
+    """Returns whether a file name matches any of the fnmatch patterns."""
+    return any(fnmatch(name, pattern) for pattern in patterns)
+
+
+def path_key(entry):
+    """Returns the sort key of a directory entry that orders the entries of
+    a directory as their paths sort, e.g. directory b after file b-1.json
+    since b/ sorts after it."""
+    if entry.is_dir(follow_symlinks=False):
+        return entry.name + os.sep
+    return entry.name
+
+
+def list_entries(directory, sort=False):
+    """Returns the entries of a directory, an empty list when it can't be
+    listed.
+
+    Keyword arguments:
+    directory - str, directory to list
+    sort - bool, sort the entries in path order, see path_key
+    """
+    try:
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except OSError as e:
+        print('Error when listing {}'.format(directory))
+        print(e)
+        return []
+
+    if sort:
+        entries.sort(key=path_key)
+    return entries
+
+
+def iter_data_files(root, include=DEFAULT_INCLUDE, exclude=DEFAULT_EXCLUDE,
+                    skip_hidden=True, sort=False):
+    """Yields the absolute paths of the files under root whose name matches
+    an include pattern and no exclude pattern, depth first, the files of a
+    subdirectory coming where it is listed in its parent.
+
+    Keyword arguments:
+    root - str, directory to search
+    include - tuple of fnmatch patterns of the file names to yield
+    exclude - tuple of fnmatch patterns of the file names to skip
+    skip_hidden - bool, skip files and directories starting with a dot
+    sort - bool, yield files in sorted path order instead of in directory
+           order
+    """
+    # an iterator over the remaining entries of each directory being walked
+    stack = [iter(list_entries(os.path.abspath(root), sort))]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+        elif skip_hidden and entry.name.startswith('.'):
+            continue
+        elif entry.is_dir(follow_symlinks=False):
+            stack.append(iter(list_entries(entry.path, sort)))
+        elif (matches(entry.name, include) and
+                not matches(entry.name, exclude)):
+            yield entry.path
+
+
+def iter_batches(iterable, size):
+    """Yields lists of up to size consecutive items of an iterable.
+
+    Keyword arguments:
+    iterable - iterable to split, consumed lazily
+    size - int, maximum number of items per list
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""This module looks for data contained in *.json files and inserts it into a
-Postgres database.
+"""This module looks for data contained in *.json files, plain or gzip/zstd
+compressed (see the readers module), or in the Parquet files of the
+parquet_stage module, and inserts it into a Postgres database.
 
 Dependencies: This module must be called after the create_tables one as its 
 dependent upon this later module to setup the database.
@@ -16,70 +17,248 @@ __maintainer__ = "Tim Fenton"
 __email__ = "tfenton@gmail.com"
 __status__ = "Production"
 
+import io
 import os
-import glob
+import json
+import time
+import hashlib
+import argparse
+import functools
+import itertools
+import collections
+import multiprocessing
+import concurrent.futures
+import cProfile
 import psycopg2
+import numpy as np
 import pandas as pd
+from psycopg2.extras import execute_values
 from sql_queries import *
+from song_cache import SongCache
+from metrics import CountingCursor
+from backends import SPARKIFY_DSN, DUCKDB_PATH, get_backend
+import metrics
+import discovery
+import parquet_stage
+import readers
+import validation
+
+SONG_COLUMNS = ('song_id', 'title', 'artist_id', 'year', 'duration')
+ARTIST_COLUMNS = ('artist_id', 'artist_name', 'artist_location',
+                  'artist_latitude', 'artist_longitude')
+
+# data files process_data looks for
+DATA_PATTERNS = readers.JSON_PATTERNS + ('*.parquet',)
+
+# number of files per shard handed to a worker process
+SHARD_FILES = 64
+
+# columns of the inserted songplays the rollup tables are computed from
+ROLLUP_COLUMNS = ['start_time', 'level', 'artist_id']
+
+MS_PER_HOUR = 3600 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
 
 
 def process_song_file(cur, filepath):
     """Opens a single song file and inserts its contents into the song and artist tables.
+    A staged Parquet file holds many songs, all of which are inserted.
 
     Keyword arguments:
     cur - Open database cursor
-    filepath - str, location of a song file in json format
+    filepath - str, location of a song file in json or Parquet format
+
+    Returns the number of valid song records, the others are written to
+    the song_rejects table. Errors are raised to process_data, which rolls
+    back and quarantines the file.
     """
     # open song file
-    df = pd.read_json(filepath, lines=True)
+    if parquet_stage.is_parquet(filepath):
+        df = parquet_stage.read_parquet(filepath,
+                                        parquet_stage.SONG_READ_COLUMNS)
+    else:
+        with metrics.stage('song_parse',
+                           bytes_read=os.path.getsize(filepath)) as stage:
+            df = readers.read_json_frame(filepath)
+            stage.rows_out = len(df)
 
-    # insert song record
-    try:
+    df = df[validate_records(cur, df, validation.SONG_RULES,
+                             song_reject_insert_values, 'song', filepath)]
+
+    # insert song records
+    with metrics.stage('song_write', rows_in=len(df)) as stage:
         song_data = df[['song_id', 'title',
-                        'artist_id', 'year', 'duration']].values[0]
-        cur.execute(song_table_insert, song_data)
-    except Exception as e:
-        print('Error when inserting song data into the songs table')
-        print(e)
+                        'artist_id', 'year', 'duration']].values
+        for song in song_data:
+            cur.execute(song_table_insert, song)
+            stage.rows_out += cur.rowcount
 
-    # insert artist record
-    try:
+    # insert artist records
+    with metrics.stage('artist_write', rows_in=len(df)) as stage:
         artist_data = df[['artist_id',
                           'artist_name',
                           'artist_location',
                           'artist_latitude',
-                          'artist_longitude']].values[0]
-        cur.execute(artist_table_insert, artist_data)
-    except Exception as e:
-        print('Error when inserting artist data into the artists table')
-        print(e)
+                          'artist_longitude']].values
+        for artist in artist_data:
+            cur.execute(artist_table_insert, artist)
+            stage.rows_out += cur.rowcount
 
-def process_log_file(cur, filepath):
-    """Opens a single log file and inserts its contents into users, time, and songplays tables.
-    Does a lookup on the song and artist tables to get get song and artist id's respectively.
+    return len(df)
+
+
+def read_song_files(filepaths):
+    """Parses a batch of song files with the json module, skipping the
+    overhead of building a DataFrame per file.
+
+    Keyword arguments:
+    filepaths - list of song file locations in json or Parquet format
+
+    Returns a dict mapping each song and artist column to a list of values,
+    one per song record, and 'source' to the file of each record.
+    """
+    columns = {c: [] for c in SONG_COLUMNS + ARTIST_COLUMNS[1:]}
+    sources = []
+    with metrics.stage('song_parse') as stage:
+        for filepath in filepaths:
+            if parquet_stage.is_parquet(filepath):
+                df = parquet_stage.read_parquet(filepath, list(columns))
+                for column, values in columns.items():
+                    values.extend(df[column].tolist())
+                sources.extend([filepath] * len(df))
+                continue
+
+            for line in readers.iter_lines(filepath):
+                stage.bytes_read += len(line)
+                record = json.loads(line)
+                for column, values in columns.items():
+                    values.append(record.get(column))
+                sources.append(filepath)
+        stage.rows_out = len(sources)
+
+    columns['source'] = sources
+
+    return columns
+
+
+def process_song_batch(cur, filepaths):
+    """Batched version of process_song_file. Reads many song files at once
+    and inserts their contents into the song and artist tables with one
+    multi-row insert per table.
 
     Keyword arguments:
     cur - Open database cursor
-    filepath - str, location of a logfile in json format
+    filepaths - list of song file locations in json or Parquet format
+
+    Returns the number of valid song records.
     """
-    # open log file
-    df = pd.read_json(filepath, lines=True)
+    return write_song_columns(cur, read_song_files(filepaths))
 
-    # filter by NextSong action
-    df = df[df.page == 'NextSong']
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df.ts, unit='ms')
+def write_song_columns(cur, columns):
+    """Inserts song records parsed by read_song_files into the song and
+    artist tables with one multi-row insert per table.
+
+    Keyword arguments:
+    cur - Open database cursor
+    columns - dict of song and artist columns returned by read_song_files
+
+    Returns the number of valid song records, the others are written to
+    the song_rejects table.
+    """
+    df = pd.DataFrame({c: columns[c] for c in SONG_COLUMNS + ARTIST_COLUMNS})
+    keep = validate_records(cur, df, validation.SONG_RULES,
+                            song_reject_insert_values, 'song',
+                            columns.get('source'))
+    if not keep.all():
+        columns = {c: list(itertools.compress(values, keep))
+                   for c, values in columns.items()}
+
+    # insert song records
+    song_data = list(zip(*(columns[c] for c in SONG_COLUMNS)))
+    with metrics.stage('song_write', rows_in=len(song_data)) as stage:
+        execute_values(cur, song_table_insert_values, song_data,
+                       page_size=max(len(song_data), 1))
+        stage.rows_out = cur.rowcount
+
+    # insert artist records
+    artist_data = list(zip(*(columns[c] for c in ARTIST_COLUMNS)))
+    with metrics.stage('artist_write', rows_in=len(artist_data)) as stage:
+        execute_values(cur, artist_table_insert_values, artist_data,
+                       page_size=max(len(artist_data), 1))
+        stage.rows_out = cur.rowcount
+
+    return len(song_data)
+
+
+def validate_records(cur, df, rules, reject_query, name, source=None):
+    """Runs the validation stage on a batch of records and writes the ones
+    that fail it to their reject table with one multi-row insert.
+
+    Keyword arguments:
+    cur - Open database cursor
+    df - DataFrame of the records of the batch
+    rules - tuple of validation rules, see the validation module
+    reject_query - str, multi-row insert into the reject table
+    name - str, kind of the records, e.g. 'song', naming the metrics stage
+    source - str, file the records were read from, or a list holding the
+             file of each record
+
+    Returns a boolean array that is True for the records to load.
+    """
+    start = time.time()
+    with metrics.stage(name + '_validate', rows_in=len(df)) as stage:
+        keep, reasons, records = validation.validate(df, rules)
+        stage.rows_out = int(keep.sum())
+
+    if reasons:
+        if source is None or isinstance(source, str):
+            sources = [source] * len(reasons)
+        else:
+            sources = list(itertools.compress(source, ~keep))
+        with metrics.stage(name + '_reject_write', rows_in=len(reasons)):
+            execute_values(cur, reject_query,
+                           list(zip(sources, reasons, records)),
+                           page_size=len(reasons))
+        print('{} of {} {} records rejected by validation in {:.3f}s'.format(
+            len(reasons), len(df), name, time.time() - start))
+
+    return keep
+
+
+def build_time_df(df):
+    """Breaks the ts column of a log DataFrame out into the time table columns.
+    Timestamps are de-duplicated and the columns are computed with NumPy
+    datetime arithmetic instead of the pandas .dt accessors.
+
+    Keyword arguments:
+    df - DataFrame of NextSong log events
+
+    Returns a DataFrame with the columns of the time table, one row per
+    distinct start_time.
+    """
+    ts = np.unique(df.ts.values.astype('int64'))
+
+    # epoch ms to calendar days, months and years
+    days = (ts // MS_PER_DAY).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = days.astype('datetime64[Y]')
+
+    # 1970-01-01 was a Thursday, weekday counts from Monday = 0
+    weekday = (days.astype('int64') + 3) % 7
+
+    # the ISO week is numbered within the year of its Thursday
+    thursday = days - weekday + 3
+    iso_year_start = thursday.astype('datetime64[Y]').astype('datetime64[D]')
 
-    # insert time data records
     time_data = (
-        df.ts,
-        t.dt.hour,
-        t.dt.day,
-        t.dt.weekofyear,
-        t.dt.month,
-        t.dt.year,
-        t.dt.weekday)
+        ts,
+        (ts // MS_PER_HOUR) % 24,
+        (days - months.astype('datetime64[D]')).astype('int64') + 1,
+        (thursday - iso_year_start).astype('int64') // 7 + 1,
+        months.astype('int64') % 12 + 1,
+        years.astype('int64') + 1970,
+        weekday)
     column_labels = (
         'start_time',
         'hour',
@@ -88,84 +267,1155 @@ def process_log_file(cur, filepath):
         'month',
         'year',
         'weekday')
-    time_df = pd.DataFrame(
-        {column_labels[i]: time_data[i] for i in range(len(time_data))})
-
-    for i, row in time_df.iterrows():
-        try:
-            cur.execute(time_table_insert, list(row))
-        except Exception as e:
-            print('Error when inserting data into the time table')
-            print(e)
+    return pd.DataFrame(
+        {column_labels[i]: time_data[i] for i in range(len(time_data))},
+        columns=column_labels)
+
+
+def build_user_df(df):
+    """Reduces a log DataFrame to one row per user, keeping the details of
+    the user's latest event so a change of level is picked up. The ts of
+    that event is kept as last_seen, so that the upserts of a file loaded
+    after a later file leave the user alone. Rows are sorted by user id so
+    concurrent loaders upsert them in the same order and don't deadlock.
+
+    Keyword arguments:
+    df - DataFrame of NextSong log events
+
+    Returns a DataFrame with the columns of the users table.
+    """
+    user_df = df.sort_values('ts', kind='mergesort')
+    user_df = user_df[['userId', 'firstName', 'lastName', 'gender', 'level',
+                       'ts']]
+    user_df = user_df.drop_duplicates('userId', keep='last')
+    user_df = user_df.sort_values('userId', kind='mergesort',
+                                  key=lambda ids: pd.to_numeric(ids))
+    return user_df.astype({'ts': 'int64'})
+
+
+def build_rollups(plays):
+    """Computes the partial aggregates of a batch of new songplays for each
+    rollup table. Rows are sorted by key so concurrent loaders upsert them
+    in the same order and don't deadlock.
+
+    Keyword arguments:
+    plays - DataFrame of the inserted songplays, with start_time, level and
+            artist_id columns
+
+    Returns a list of row lists, in the order of rollup_upsert_queries.
+    """
+    start = plays.start_time.values.astype('int64')
+
+    # plays per hour
+    hours, counts = np.unique(start - start % MS_PER_HOUR, return_counts=True)
+    hour_rows = list(zip(hours.tolist(), counts.tolist()))
+
+    # plays per day and user level
+    levels = plays.level.groupby(start - start % MS_PER_DAY).value_counts()
+    level_rows = [(int(day), level, int(count))
+                  for (day, level), count in levels.sort_index().items()]
+
+    # plays per artist, songplays of unknown songs have no artist
+    artists = plays.artist_id.dropna().value_counts().sort_index()
+    artist_rows = [(artist, int(count)) for artist, count in artists.items()]
+
+    return [hour_rows, level_rows, artist_rows]
+
+
+def update_rollups(cur, plays):
+    """Adds a batch of new songplays to the rollup tables with one upsert
+    per table.
+
+    Keyword arguments:
+    cur - Open database cursor
+    plays - DataFrame of the inserted songplays, with start_time, level and
+            artist_id columns
+    """
+    with metrics.stage('rollup_write', rows_in=len(plays)) as stage:
+        for query, rows in zip(rollup_upsert_queries, build_rollups(plays)):
+            if rows:
+                execute_values(cur, query, rows, page_size=len(rows))
+                stage.rows_out += len(rows)
+
+
+def is_partitioned(cur, conn, table):
+    """Returns whether a table is partitioned. Servers before Postgres 10
+    have no pg_partitioned_table catalog and no partitioned tables.
+
+    Keyword arguments:
+    cur - open cursor to the sparkify database
+    conn - open connection to the sparkify database
+    table - str, name of the table, resolved through the search_path
+    """
+    if conn.server_version < 100000:
+        return False
+    cur.execute(partitioned_table_select, (table,))
+    return cur.fetchone()[0]
+
+
+def ensure_partitions(cur, df):
+    """Creates the monthly partitions of songplays and time that the events
+    of a DataFrame fall into, if they don't exist yet. The partitions are
+    looked up first and the advisory lock that keeps concurrent workers from
+    creating the same partition is only taken for a missing one, so loads
+    into existing months never wait on each other.
+
+    Keyword arguments:
+    cur - Open database cursor
+    df - DataFrame of NextSong log events
+    """
+    days = (df.ts.values.astype('int64') // MS_PER_DAY).astype('datetime64[D]')
+    partitions = {}
+    for month in np.unique(days.astype('datetime64[M]')):
+        bounds = np.array([month, month + 1]).astype('datetime64[D]')
+        start, end = (bounds.astype('int64') * MS_PER_DAY).tolist()
+        year, month_of_year = divmod(int(month.astype('int64')), 12)
+        for table in partitioned_tables:
+            partition = '{}_y{:04d}m{:02d}'.format(table, year + 1970,
+                                                   month_of_year + 1)
+            partitions[partition] = (table, start, end)
+    if not partitions:
+        return
+
+    # one round trip finds the missing partitions, in month order so that
+    # loads creating several of them lock them in the same order
+    cur.execute(partitions_missing_select, (list(partitions),))
+    for (partition,) in cur.fetchall():
+        table, start, end = partitions[partition]
+        cur.execute(partition_lock, (partition,))
+        cur.execute(partition_create.format(
+            table=table, partition=partition, start=start, end=end))
+
+
+def copy_dataframe(cur, df, copy_sql):
+    """Streams a DataFrame into Postgres with a single COPY FROM STDIN.
+
+    Keyword arguments:
+    cur - Open database cursor
+    df - DataFrame whose columns are in the order of the COPY column list
+    copy_sql - str, COPY ... FROM STDIN WITH CSV statement to run
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, header=False, index=False)
+    buf.seek(0)
+    cur.copy_expert(copy_sql, buf)
+
+
+def query_song_ids(cur, triples):
+    """Resolves (song, artist, length) triples against the songs and artists
+    tables. The triples are copied into a temp table and resolved with a
+    single joined query.
+
+    Keyword arguments:
+    cur - Open database cursor
+    triples - DataFrame of distinct song, artist and length values
+
+    Returns a dict mapping each triple that was found to (song_id, artist_id).
+    """
+    cur.execute(song_lookup_staging_create)
+    cur.execute(song_lookup_staging_truncate)
+    copy_dataframe(cur, triples, song_lookup_staging_copy)
+    cur.execute(song_lookup_select)
+
+    found = {}
+    for song, artist, length, songid, artistid in cur.fetchall():
+        found.setdefault((song, artist, length), (songid, artistid))
+
+    return found
+
+
+def lookup_song_ids(cur, df, cache=None):
+    """Looks up the song and artist id of every event in a log DataFrame.
+    Each distinct (song, artist, length) triple is resolved once, from the
+    song cache when one is given and from the database otherwise.
+
+    Keyword arguments:
+    cur - Open database cursor
+    df - DataFrame of NextSong log events
+    cache - SongCache, optional in-memory index of the song dimension
+
+    Returns a tuple of two lists (song ids, artist ids) aligned with df,
+    holding None for events whose song could not be found.
+    """
+    keys = ['song', 'artist', 'length']
+    triples = df[keys].drop_duplicates()
+
+    # events missing a part of the triple can't match a song
+    triples = triples[triples.notnull().all(axis=1).values]
+
+    if cache is None:
+        found = query_song_ids(cur, triples)
+    else:
+        found, missing = {}, []
+        for triple in triples.itertuples(index=False, name=None):
+            ids = cache.get(triple)
+            if ids is None:
+                missing.append(triple)
+            else:
+                found[triple] = ids
+
+        # fall back to the database on a miss, remembering unknown songs too
+        if missing:
+            queried = query_song_ids(cur, pd.DataFrame(missing, columns=keys))
+            for triple in missing:
+                ids = queried.get(triple, (None, None))
+                cache.put(triple, ids)
+                found[triple] = ids
+
+    ids = [found.get(triple, (None, None))
+           for triple in df[keys].itertuples(index=False, name=None)]
+
+    return [i[0] for i in ids], [i[1] for i in ids]
+
+
+def read_log_file(filepath):
+    """Opens a single log file and filters it down to the NextSong events.
+
+    Keyword arguments:
+    filepath - str, location of a logfile in json or Parquet format
+
+    Returns a DataFrame of the NextSong events.
+    """
+    # open log file
+    if parquet_stage.is_parquet(filepath):
+        df = parquet_stage.read_parquet(filepath,
+                                        parquet_stage.EVENT_READ_COLUMNS)
+    else:
+        with metrics.stage('log_parse',
+                           bytes_read=os.path.getsize(filepath)) as stage:
+            df = readers.read_json_frame(filepath)
+            stage.rows_out = len(df)
+
+    # filter by NextSong action
+    with metrics.stage('next_song_filter', rows_in=len(df)) as stage:
+        df = df[df.page == 'NextSong']
+        stage.rows_out = len(df)
+
+    return df
+
+
+def process_log_file(cur, filepath, cache=None, partitioned=False):
+    """Opens a single log file and inserts its contents into users, time, and songplays tables.
+    Does a lookup on the song and artist tables to get get song and artist id's respectively.
+
+    Keyword arguments:
+    cur - Open database cursor
+    filepath - str, location of a logfile in json format
+    cache - SongCache, optional in-memory index used for the song lookup
+    partitioned - bool, whether songplays and time are partitioned by month
+
+    Returns the number of NextSong events loaded. Errors are raised to
+    process_data, which rolls back and quarantines the file.
+    """
+    # open log file and filter by NextSong action
+    df = read_log_file(filepath)
+
+    return load_log_df(cur, df, cache, partitioned, filepath)
+
+
+def load_log_df(cur, df, cache=None, partitioned=False, source=None):
+    """Inserts a DataFrame of NextSong events into the users, time, and
+    songplays tables with one insert per songplay.
+
+    Keyword arguments:
+    cur - Open database cursor
+    df - DataFrame of NextSong log events
+    cache - SongCache, optional in-memory index used for the song lookup
+    partitioned - bool, whether songplays and time are partitioned by month
+    source - str, file the events were read from, recorded with the events
+             that fail validation
+
+    Returns the number of valid NextSong events, the others are written to
+    the event_rejects table.
+    """
+    df = df[validate_records(cur, df, validation.EVENT_RULES,
+                             event_reject_insert_values, 'event', source)]
+
+    if partitioned:
+        ensure_partitions(cur, df)
+
+    # insert time data records
+    with metrics.stage('time_write') as stage:
+        time_df = build_time_df(df)
+        stage.rows_in = len(time_df)
+        execute_values(cur, time_table_insert_values,
+                       time_df.values.tolist(),
+                       page_size=max(len(time_df), 1))
+        stage.rows_out = cur.rowcount
 
     # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    with metrics.stage('user_write') as stage:
+        user_df = build_user_df(df)
+        stage.rows_in = len(user_df)
 
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+        # insert user records
+        execute_values(cur, user_table_insert_values, user_df.values.tolist(),
+                       page_size=max(len(user_df), 1))
+        stage.rows_out = cur.rowcount
 
-    # insert songplay records
-    for index, row in df.iterrows():
+    # get songid and artistid from song and artist tables
+    with metrics.stage('songplay_lookup', rows_in=len(df)) as stage:
+        song_ids, artist_ids = lookup_song_ids(cur, df, cache)
+        stage.rows_out = sum(1 for songid in song_ids if songid is not None)
 
-        # get songid and artistid from song and artist tables
-        artist = row.artist.replace("'", "''")
-        try:
-            cur.execute(song_select, (row.song, artist, row.length))
-        except Exception as e:
-            print('Error when selecting song and artist ids')
-            print(e)
-        
-        results = cur.fetchone()
+    # insert songplay records, keeping the ones that are new for the rollups
+    inserted = []
+    with metrics.stage('songplay_write', rows_in=len(df)) as stage:
+        rows = zip(df.iterrows(), song_ids, artist_ids)
+        for (index, row), songid, artistid in rows:
 
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
-
-        # insert songplay record
-        songplay_data = (
-            row.itemInSession,
-            row.ts,
-            row.userId,
-            row.level,
-            songid,
-            artistid,
-            row.sessionId,
-            row.location,
-            row.userAgent)
-        try:
+            # insert songplay record
+            songplay_data = (
+                row.ts,
+                row.userId,
+                row.level,
+                songid,
+                artistid,
+                row.sessionId,
+                row.itemInSession,
+                row.location,
+                row.userAgent)
             cur.execute(songplay_table_insert, songplay_data)
-        except Exception as e:
-            print('Error when inserting data into the songplays table')
+            stage.rows_out += cur.rowcount
+            if cur.rowcount == 1:
+                inserted.append((row.ts, row.level, artistid))
+
+    update_rollups(cur, pd.DataFrame(inserted, columns=ROLLUP_COLUMNS))
+
+    return len(df)
+
+
+def load_log_df_bulk(cur, df, cache=None, partitioned=False, source=None):
+    """Loads a DataFrame of NextSong events with COPY. Each of the time, users
+    and songplays DataFrames is streamed into a staging table and then merged
+    into its sparkify table with a single INSERT ... SELECT.
+
+    Keyword arguments:
+    cur - Open database cursor
+    df - DataFrame of NextSong log events
+    cache - SongCache, optional in-memory index used for the song lookup
+    partitioned - bool, whether songplays and time are partitioned by month
+    source - str, file the events were read from, recorded with the events
+             that fail validation
+
+    Returns the number of valid NextSong events, the others are written to
+    the event_rejects table.
+    """
+    df = df[validate_records(cur, df, validation.EVENT_RULES,
+                             event_reject_insert_values, 'event', source)]
+
+    if partitioned:
+        ensure_partitions(cur, df)
+
+    # staging tables only live until the batch's transaction commits and are
+    # emptied between files and the chunks of a streamed file
+    cur.execute(time_staging_create)
+    cur.execute(user_staging_create)
+    cur.execute(songplay_staging_create)
+    cur.execute(staging_truncate)
+
+    # load time records
+    with metrics.stage('time_write') as stage:
+        time_df = build_time_df(df)
+        stage.rows_in = len(time_df)
+        copy_dataframe(cur, time_df, time_staging_copy)
+        cur.execute(time_table_merge)
+        stage.rows_out = cur.rowcount
+
+    # load user records, keeping the latest row per user
+    with metrics.stage('user_write') as stage:
+        user_df = build_user_df(df)
+        stage.rows_in = len(user_df)
+        copy_dataframe(cur, user_df, user_staging_copy)
+        cur.execute(user_table_merge)
+        stage.rows_out = cur.rowcount
+
+    # load songplay records
+    with metrics.stage('songplay_lookup', rows_in=len(df)) as stage:
+        song_ids, artist_ids = lookup_song_ids(cur, df, cache)
+        stage.rows_out = sum(1 for songid in song_ids if songid is not None)
+
+    with metrics.stage('songplay_write', rows_in=len(df)) as stage:
+        songplay_df = df[['ts', 'userId', 'level']].copy()
+        songplay_df['song_id'] = song_ids
+        songplay_df['artist_id'] = artist_ids
+        songplay_df['sessionId'] = df.sessionId
+        songplay_df['itemInSession'] = df.itemInSession
+        songplay_df['location'] = df.location
+        songplay_df['userAgent'] = df.userAgent
+        copy_dataframe(cur, songplay_df, songplay_staging_copy)
+        cur.execute(songplay_table_merge)
+        stage.rows_out = cur.rowcount
+        inserted = cur.fetchall()
+
+    update_rollups(cur, pd.DataFrame(inserted, columns=ROLLUP_COLUMNS))
+
+    return len(df)
+
+
+def process_log_file_bulk(cur, filepath, cache=None, partitioned=False):
+    """Bulk version of process_log_file, loading the file with COPY through
+    staging tables.
+
+    Keyword arguments:
+    cur - Open database cursor
+    filepath - str, location of a logfile in json format
+    cache - SongCache, optional in-memory index used for the song lookup
+    partitioned - bool, whether songplays and time are partitioned by month
+
+    Returns the number of NextSong events loaded.
+    """
+    # open log file and filter by NextSong action
+    df = read_log_file(filepath)
+
+    return load_log_df_bulk(cur, df, cache, partitioned, filepath)
+
+
+def process_log_file_stream(cur, filepath, cache=None, chunksize=100000,
+                            partitioned=False):
+    """Streaming version of process_log_file_bulk for log files too large to
+    hold in memory. The file is read in chunks of events and each chunk is
+    filtered, transformed and loaded before the next one is read.
+
+    Keyword arguments:
+    cur - Open database cursor
+    filepath - str, location of a logfile in json format
+    cache - SongCache, optional in-memory index used for the song lookup
+    chunksize - int, number of events read per chunk
+    partitioned - bool, whether songplays and time are partitioned by month
+
+    Returns the number of NextSong events loaded.
+    """
+    rows = 0
+    if parquet_stage.is_parquet(filepath):
+        reader = parquet_stage.iter_parquet(
+            filepath, parquet_stage.EVENT_READ_COLUMNS, chunksize)
+    else:
+        reader = readers.iter_json_frames(filepath, chunksize)
+    while True:
+        start = time.time()
+        with metrics.stage('log_parse') as stage:
+            chunk = next(reader, None)
+            stage.rows_out = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+        num_events = len(chunk)
+
+        # filter by NextSong action
+        with metrics.stage('next_song_filter', rows_in=num_events) as stage:
+            df = chunk[chunk.page == 'NextSong']
+            stage.rows_out = len(df)
+        del chunk
+
+        rows += load_log_df_bulk(cur, df, cache, partitioned, filepath)
+
+        elapsed = max(time.time() - start, 1e-9)
+        print('{} events ({} NextSong) loaded in {:.2f}s, '
+              '{:.0f} events/sec'.format(num_events, len(df), elapsed,
+                                         num_events / elapsed))
+
+    return rows
+
+
+def file_hash(filepath):
+    """Returns the sha1 hex digest of a file's content.
+
+    Keyword arguments:
+    filepath - str, location of the file
+    """
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def file_changed(datafile, size, mtime, content_hash):
+    """Returns whether a file differs from its load manifest entry. A file
+    is only hashed when its size or mtime changed since it was loaded.
+
+    Keyword arguments:
+    datafile - str, location of the file
+    size - int, size of the file when it was loaded
+    mtime - float, mtime of the file when it was loaded
+    content_hash - str, sha1 hex digest of the file when it was loaded
+    """
+    stat = os.stat(datafile)
+    if (stat.st_size, stat.st_mtime) == (size, mtime):
+        return False
+
+    return file_hash(datafile) != content_hash
+
+
+def select_files(cur, all_files, manifest=False, retry_quarantine=False,
+                 counts=None):
+    """Lazily drops the files that the load manifest records as loaded and
+    unchanged, and the files that are quarantined. The manifest and the
+    quarantine are read up front, the files themselves as they are needed.
+
+    Keyword arguments:
+    cur - open cursor to the database
+    all_files - iterable of the file paths found by process_data
+    manifest - bool, skip the files the manifest lists as loaded
+    retry_quarantine - bool, keep the quarantined files
+    counts - collections.Counter, counts the 'found', 'loaded' and
+             'quarantined' files as they are seen
+
+    Returns an iterator of the new or changed files.
+    """
+    loaded = {}
+    if manifest:
+        cur.execute(manifest_select)
+        loaded = {path: (size, mtime, content_hash)
+                  for path, size, mtime, content_hash in cur.fetchall()}
+
+    # files that failed before are only retried on request
+    quarantined = set()
+    if not retry_quarantine:
+        cur.execute(quarantine_select)
+        quarantined = set(path for path, in cur.fetchall())
+
+    counts = collections.Counter() if counts is None else counts
+
+    def select():
+        for datafile in all_files:
+            counts['found'] += 1
+            if datafile in quarantined:
+                counts['quarantined'] += 1
+            elif (datafile in loaded and
+                    not file_changed(datafile, *loaded[datafile])):
+                counts['loaded'] += 1
+            else:
+                yield datafile
+
+    return select()
+
+
+def record_loaded_files(cur, filepaths):
+    """Adds files to the load manifest. This is run in the same transaction
+    as the data of the files so both are committed together.
+
+    Keyword arguments:
+    cur - open cursor to the database
+    filepaths - list of file paths that were loaded
+    """
+    for datafile in filepaths:
+        stat = os.stat(datafile)
+        cur.execute(manifest_table_upsert, (
+            datafile, stat.st_size, stat.st_mtime, file_hash(datafile)))
+
+
+def load_files(cur, load, filepaths, manifest=False, retried=False,
+               file_load=None):
+    """Runs one load inside a savepoint. If it fails only its own statements
+    are rolled back and its files are quarantined with the error, in the
+    same transaction, so the rest of the batch can still commit. A failed
+    load of several files is retried file by file when file_load is given,
+    so only the files that fail on their own are quarantined.
+
+    Keyword arguments:
+    cur - open cursor to the database
+    load - function taking no arguments that loads the files with cur and
+           returns the number of rows loaded
+    filepaths - list of the file paths the load covers
+    manifest - bool, record the loaded files in the load manifest
+    retried - bool, whether the files may be in the quarantine table
+    file_load - function taking a file path and returning the load function
+                of that file alone
+
+    Returns a tuple of the number of rows loaded and of files that failed.
+    """
+    cur.execute(file_savepoint)
+    try:
+        rows = load() or 0
+        if manifest:
+            record_loaded_files(cur, filepaths)
+        if retried:
+            for datafile in filepaths:
+                cur.execute(quarantine_delete, (datafile,))
+        cur.execute(file_savepoint_release)
+        return rows, 0
+    except Exception as e:
+        cur.execute(file_savepoint_rollback)
+        if file_load is not None and len(filepaths) > 1:
+            print('Error when processing a batch of {} files, retrying them '
+                  'one by one'.format(len(filepaths)))
             print(e)
+            rows, failed = 0, 0
+            for datafile in filepaths:
+                loaded, errors = load_files(cur, file_load(datafile),
+                                            [datafile], manifest, retried)
+                rows += loaded
+                failed += errors
+            return rows, failed
+
+        for datafile in filepaths:
+            cur.execute(quarantine_table_upsert, (datafile, str(e)))
+        print('Error when processing {}, quarantined'.format(filepaths))
+        print(e)
+        return 0, len(filepaths)
+
+
+def batch_file_load(cur, func, reader, datafile):
+    """Returns the load function of a single file of a failed batch, for
+    load_files to retry it on its own.
+
+    Keyword arguments:
+    cur - open cursor to the database
+    func - function pointer loading a batch of files, or the output of
+           reader for a batch when reader is given
+    reader - function pointer parsing a batch of files, or None
+    datafile - str, the file to load
+    """
+    if reader is None:
+        return functools.partial(func, cur, [datafile])
+
+    def load():
+        return func(cur, reader([datafile]))
+    return load
+
+
+def commit_batch(cur, conn, rows):
+    """Commits a batch of loads. When the batch loaded rows the load version
+    is bumped in the same transaction, which drops the cached results of
+    the analytics module once the rows are visible.
+
+    Keyword arguments:
+    cur - open cursor to the database
+    conn - open connection to the database
+    rows - int, number of rows the batch loaded
+    """
+    if rows:
+        cur.execute(load_version_bump)
+    conn.commit()
+
+
+def commit_loads(cur, conn, loads, manifest=False, retried=False,
+                 commit_files=1, commit_rows=0, file_load=None):
+    """Runs loads with load_files, committing once commit_files files or
+    commit_rows rows are loaded since the last commit, and at the end.
 
+    Keyword arguments:
+    cur - open cursor to the database
+    conn - open connection to the database
+    loads - iterable of (list of file paths, load function) pairs
+    manifest - bool, record loaded files in the load manifest
+    retried - bool, whether the files may be in the quarantine table
+    commit_files - int, number of files committed per transaction
+    commit_rows - int, commit early once this many rows are loaded (0 only
+                  commits by number of files)
+    file_load - function taking a file path and returning the load function
+                of that file alone, used to retry the files of a failed
+                batch one by one
+
+    Returns a tuple of the number of files processed and failed.
+    """
+    processed, errors = 0, 0
+    pending_files, pending_rows = 0, 0
+    for filepaths, load in loads:
+        rows, failed = load_files(cur, load, filepaths, manifest, retried,
+                                  file_load)
+        processed += len(filepaths)
+        pending_files += len(filepaths)
+        errors += failed
+        pending_rows += rows
+
+        if (pending_files >= commit_files or
+                (commit_rows and pending_rows >= commit_rows)):
+            with metrics.stage('commit'):
+                commit_batch(cur, conn, pending_rows)
+            pending_files, pending_rows = 0, 0
+            print('{} files processed, {} errors.'.format(processed, errors))
+
+    if pending_files:
+        with metrics.stage('commit'):
+            commit_batch(cur, conn, pending_rows)
+        print('{} files processed, {} errors.'.format(processed, errors))
+
+    return processed, errors
+
+
+def init_worker(func, batched, manifest, dsn, metrics_path=None,
+                retried=False, commit_files=1, commit_rows=0):
+    """Initializer of the worker processes used by process_data. Each worker
+    opens its own connection to the sparkify database.
+
+    Keyword arguments:
+    func - function pointer to insert data (song, artist, songplays)
+    batched - bool, whether func takes a list of files instead of one file
+    manifest - bool, whether loaded files are recorded in the load manifest
+    dsn - str, connection string of the database to load
+    metrics_path - str, JSON-lines file the worker appends its metrics to
+    retried - bool, whether the files may be in the quarantine table
+    commit_files - int, number of files committed per transaction
+    commit_rows - int, commit early once this many rows are loaded
+    """
+    global worker_conn, worker_cur, worker_func, worker_batched
+    global worker_manifest, worker_retried, worker_commit
+    metrics.configure(metrics_path)
+    worker_conn = psycopg2.connect(dsn, cursor_factory=CountingCursor)
+    worker_cur = worker_conn.cursor()
+    worker_func = func
+    worker_batched = batched
+    worker_manifest = manifest
+    worker_retried = retried
+    worker_commit = (commit_files, commit_rows)
+
+
+def func_cache(func):
+    """Returns the SongCache bound to a loading function with
+    functools.partial, or None."""
+    return getattr(func, 'keywords', {}).get('cache')
+
+
+def process_shard(files):
+    """Processes a shard of files inside a worker process, committing them
+    in batches.
+
+    Keyword arguments:
+    files - list of file paths to process
+
+    Returns a tuple of the number of files processed and failed, and of
+    the counters the worker's song cache gained over the shard (or None
+    when the load has no song cache).
+    """
+    cache = func_cache(worker_func)
+    counters = None if cache is None else cache.counters()
 
-def process_data(cur, conn, filepath, func):
+    # a batched function gets the whole shard as one batch, whose files are
+    # retried one by one if it fails
+    file_load = None
+    if worker_batched:
+        loads = [(files, functools.partial(worker_func, worker_cur, files))]
+        file_load = functools.partial(batch_file_load, worker_cur,
+                                      worker_func, None)
+    else:
+        loads = (([datafile], functools.partial(worker_func, worker_cur,
+                                                datafile))
+                 for datafile in files)
+
+    commit_files, commit_rows = worker_commit
+    result = commit_loads(worker_cur, worker_conn, loads, worker_manifest,
+                          worker_retried, commit_files, commit_rows,
+                          file_load)
+
+    metrics.flush('shard')
+    if cache is not None:
+        counters = [after - before for after, before in zip(
+            cache.counters(), counters)]
+    return result + (counters,)
+
+
+def process_data(cur, conn, filepath, func, workers=1, batch_size=None,
+                 manifest=False, full_refresh=False, dsn=SPARKIFY_DSN,
+                 reader=None, pipeline=0, commit_files=1, commit_rows=0,
+                 retry_quarantine=False, include=DATA_PATTERNS,
+                 exclude=discovery.DEFAULT_EXCLUDE, skip_hidden=True,
+                 sort_files=False):
     """Processes all files in a path and inserts their data into the db.
+    Files are discovered lazily and loading starts with the first ones found.
+    Every file (or batch of files) is loaded inside a savepoint, and files
+    that fail are rolled back on their own and added to the quarantine
+    table, which later runs skip unless retry_quarantine is set.
 
     Arguments:
     cur - open cursor to the database
     conn - open connection to the database
     filepath - directory string in which to look for any json files
+    func - function pointer to insert data (song, artist, songplays),
+           returning the number of rows it loaded
+    workers - int, number of worker processes, each with its own connection.
+              The files are processed on cur/conn when this is 1
+    batch_size - int, when given func is called with lists of up to this
+                 many files (e.g. process_song_batch) instead of one file
+    manifest - bool, record loaded files in the load manifest and skip the
+               files it lists as loaded and unchanged
+    full_refresh - bool, process every file even if the manifest lists it
+    dsn - str, connection string the worker processes connect with
+    reader - function pointer parsing a file (or batch of files) for func,
+             which then takes the parsed data instead of the file. Used
+             together with pipeline
+    pipeline - int, number of files (or batches) parsed ahead of the
+               database writes by reader on a background thread
+    commit_files - int, number of files committed per transaction
+    commit_rows - int, commit early once this many rows are loaded since
+                  the last commit (0 only commits by number of files)
+    retry_quarantine - bool, also process the quarantined files
+    include - tuple of fnmatch patterns of the data file names
+    exclude - tuple of fnmatch patterns of file names to skip
+    skip_hidden - bool, skip hidden files and directories such as
+                  .ipynb_checkpoints
+    sort_files - bool, process the files in a deterministic order
+    """
+    # find files matching the patterns, only new or changed ones are kept
+    counts = collections.Counter()
+    all_files = discovery.iter_data_files(filepath, include, exclude,
+                                          skip_hidden, sort_files)
+    all_files = select_files(cur, all_files, manifest and not full_refresh,
+                             retry_quarantine, counts)
+
+    if workers > 1:
+        processed, errors = process_data_parallel(
+            all_files, func, workers, batch_size, manifest, dsn,
+            retry_quarantine, commit_files, commit_rows)
+    else:
+        if batch_size:
+            items = discovery.iter_batches(all_files, batch_size)
+        else:
+            items = all_files
+
+        if pipeline > 0:
+            loads = pipelined_loads(cur, items, reader, func, pipeline,
+                                    bool(batch_size))
+        else:
+            loads = ((item if batch_size else [item],
+                      functools.partial(func, cur, item)) for item in items)
+
+        # the files of a failed batch are retried one by one
+        file_load = None
+        if batch_size:
+            file_load = functools.partial(batch_file_load, cur, func,
+                                          reader if pipeline > 0 else None)
+
+        processed, errors = commit_loads(cur, conn, loads, manifest,
+                                         retry_quarantine, commit_files,
+                                         commit_rows, file_load)
+
+    print('{} files found in {}: {} already loaded and unchanged, '
+          '{} processed, {} errors.'.format(counts['found'], filepath,
+                                            counts['loaded'], processed,
+                                            errors))
+    if counts['quarantined']:
+        print('{} files skipped as quarantined, rerun with '
+              '--retry-quarantine to retry them'.format(
+                  counts['quarantined']))
+
+
+def write_parsed(cur, func, future, source=None):
+    """Waits for a file parsed on the reader thread and writes it.
+
+    Keyword arguments:
+    cur - open cursor to the database
+    func - function pointer writing the parsed data with cur
+    future - concurrent.futures.Future of the parsed data
+    source - str, the parsed file, passed on to func as its source keyword
+             argument. None for batches, whose readers record the file of
+             each record themselves
+
+    Returns the number of rows func loaded.
+    """
+    # time spent here is the writer waiting on the reader
+    with metrics.stage('pipeline_wait'):
+        parsed = future.result()
+
+    if source is None:
+        return func(cur, parsed)
+    return func(cur, parsed, source=source)
+
+
+def pipelined_loads(cur, items, reader, func, depth, batched=False):
+    """Overlaps the parsing of upcoming files with the database writes of
+    the current one. A background thread runs reader on up to depth files
+    (or batches) ahead of the writer, which bounds the parsed data held in
+    memory. Loads are yielded in the order of items.
+
+    Arguments:
+    cur - open cursor to the database
+    items - list of file paths, or of lists of file paths when batched
+    reader - function pointer parsing an item
+    func - function pointer writing the output of reader with cur
+    depth - int, maximum number of parsed files (or batches) queued
+    batched - bool, whether the items are lists of files
+
+    Yields (list of file paths, load function) pairs for commit_loads.
+    """
+    items = iter(items)
+    queue = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        while True:
+            # top the queue up to depth files being or done parsing
+            for item in itertools.islice(items, depth - len(queue)):
+                queue.append((item, pool.submit(reader, item)))
+            if not queue:
+                return
+
+            item, future = queue.popleft()
+            yield (item if batched else [item],
+                   functools.partial(write_parsed, cur, func, future,
+                                     None if batched else item))
+
+
+def process_data_parallel(all_files, func, workers, batch_size=None,
+                          manifest=False, dsn=SPARKIFY_DSN,
+                          retry_quarantine=False, commit_files=1,
+                          commit_rows=0):
+    """Spreads files over a pool of worker processes, handing out shards as
+    soon as they are discovered. The call only returns once every file has
+    been processed, so a later pass can rely on the data of this one.
+
+    Arguments:
+    all_files - iterable of file paths to process
     func - function pointer to insert data (song, artist, songplays)
+    workers - int, number of worker processes
+    batch_size - int, when given each shard is one batch of this many files
+    manifest - bool, whether loaded files are recorded in the load manifest
+    dsn - str, connection string the worker processes connect with
+    retry_quarantine - bool, whether the files may be in the quarantine table
+    commit_files - int, number of files committed per transaction
+    commit_rows - int, commit early once this many rows are loaded
+
+    Returns a tuple of the number of files processed and failed.
     """
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root, '*.json'))
-        for f in files:
-            all_files.append(os.path.abspath(f))
+    # small shards so a slow shard doesn't hold up the pool, the number of
+    # files isn't known until discovery is done
+    shards = discovery.iter_batches(all_files, batch_size or SHARD_FILES)
+
+    # each worker fills its own copy of the song cache, their counters are
+    # added to the cache of this process so it reports on the whole pass
+    cache = func_cache(func)
+    processed, errors = 0, 0
+    pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                initargs=(func, bool(batch_size), manifest,
+                                          dsn, metrics.log_path,
+                                          retry_quarantine, commit_files,
+                                          commit_rows))
+    try:
+        for done, failed, counters in pool.imap_unordered(process_shard,
+                                                          shards):
+            processed += done
+            errors += failed
+            if counters is not None:
+                cache.add_counters(counters)
+            print('{} files processed, {} errors.'.format(processed, errors))
+    finally:
+        pool.close()
+        pool.join()
+
+    return processed, errors
+
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+def run_index_queries(cur, conn, queries, name):
+    """Runs and commits a list of index statements, timing them as a stage.
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    Keyword arguments:
+    cur - open cursor to the database
+    conn - open connection to the database
+    queries - list of CREATE INDEX or DROP INDEX statements
+    name - str, name of the stage the statements are timed as
+    """
+    start = time.time()
+    with metrics.stage(name, rows_in=len(queries)):
+        for query in queries:
+            cur.execute(query)
         conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+    print('{}: {} statements in {:.2f}s'.format(name, len(queries),
+                                                 time.time() - start))
+
+
+def build_arg_parser(add_help=True):
+    """Returns the argument parser holding the options of the etl run.
+
+    Keyword arguments:
+    add_help - bool, False when the parser is used as a parent parser
+    """
+    parser = argparse.ArgumentParser(description='Load the sparkify database',
+                                     add_help=add_help)
+    parser.add_argument('--backend', choices=['postgres', 'duckdb'],
+                        default='postgres',
+                        help='database to load, duckdb loads an embedded '
+                             'database file straight from the json trees')
+    parser.add_argument('--duckdb-path', default=DUCKDB_PATH,
+                        help='database file of the duckdb backend')
+    parser.add_argument('--bulk', action='store_true',
+                        help='load log files with COPY instead of row inserts')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='stream log files in chunks of N events, '
+                             'loading each chunk with COPY (implies --bulk)')
+    parser.add_argument('--cache-mb', type=float, default=0,
+                        help='memory cap in MB of the in-memory song cache '
+                             'used to resolve songplays (0 disables it)')
+    parser.add_argument('--song-batch', type=int, default=0,
+                        help='parse song files with the json module and '
+                             'insert them N files at a time (0 loads one '
+                             'file at a time with pandas)')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='reload every file, ignoring the load manifest')
+    parser.add_argument('--commit-files', type=int, default=1, metavar='N',
+                        help='number of files committed per transaction, '
+                             'each file is loaded inside a savepoint')
+    parser.add_argument('--commit-rows', type=int, default=0, metavar='M',
+                        help='commit early once M rows are loaded since the '
+                             'last commit (0 only commits every N files)')
+    parser.add_argument('--retry-quarantine', action='store_true',
+                        help='retry the files that failed to load before, '
+                             'which are skipped otherwise')
+    parser.add_argument('--include', action='append', metavar='PATTERN',
+                        help='file name pattern of the data files, can be '
+                             'repeated (default *.json, *.jsonl, their .gz '
+                             'and .zst variants and *.parquet)')
+    parser.add_argument('--exclude', action='append', metavar='PATTERN',
+                        help='file name pattern of files to skip, can be '
+                             'repeated (default *-checkpoint.*)')
+    parser.add_argument('--include-hidden', action='store_true',
+                        help='also load hidden files and directories, such '
+                             'as .ipynb_checkpoints')
+    parser.add_argument('--sort-files', action='store_true',
+                        help='load files in a deterministic order')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes loading files, '
+                             'each with its own database connection')
+    parser.add_argument('--pipeline', type=int, default=0, metavar='DEPTH',
+                        help='parse up to DEPTH files ahead on a reader '
+                             'thread while the previous ones are written '
+                             '(0 parses and writes each file in turn)')
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help='drop the managed indexes while loading and '
+                             'rebuild them after the pass that needs them')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='append per-stage metrics (wall time, rows, '
+                             'statements, bytes read) to a JSON-lines file')
+    parser.add_argument('--parquet', action='store_true',
+                        help='convert new json files into the Parquet '
+                             'staging layer and load from it')
+    parser.add_argument('--parquet-dir', default=parquet_stage.PARQUET_DIR,
+                        help='root directory of the Parquet staging layer')
+    return parser
+
+
+def check_args(parser, args):
+    """Exits with a usage error on combinations of etl options that don't
+    work together.
+
+    Keyword arguments:
+    parser - argparse.ArgumentParser the options were parsed with
+    args - argparse.Namespace holding the options of build_arg_parser
+    """
+    if args.parquet and args.backend != 'postgres':
+        parser.error('--parquet only applies to the postgres backend')
+    if args.pipeline > 0 and (args.workers > 1 or args.chunk_size > 0):
+        parser.error('--pipeline can not be combined with --workers or '
+                     '--chunk-size')
+
+
+def discovery_options(args):
+    """Returns the keyword arguments of process_data that select the data
+    files, from the options of build_arg_parser.
+
+    Keyword arguments:
+    args - argparse.Namespace holding the options of build_arg_parser
+    """
+    return {'include': tuple(args.include or DATA_PATTERNS),
+            'exclude': tuple(args.exclude or discovery.DEFAULT_EXCLUDE),
+            'skip_hidden': not args.include_hidden,
+            'sort_files': args.sort_files}
+
+
+def source_paths(args, song_path='data/song_data', log_path='data/log_data'):
+    """Returns the directories of the song and log files to load. With the
+    --parquet option the json files that are new since the last run are
+    staged first and the staged directories are returned.
+
+    Keyword arguments:
+    args - argparse.Namespace holding the options of build_arg_parser
+    song_path - directory string of the song json files
+    log_path - directory string of the log json files
+    """
+    if args.parquet:
+        return parquet_stage.stage_data(song_path, log_path, args.parquet_dir)
+
+    return song_path, log_path
+
+
+def run_song_pass(cur, conn, args, filepath='data/song_data',
+                  dsn=SPARKIFY_DSN):
+    """Loads the songs and artists tables from a tree of song files.
+
+    Keyword arguments:
+    cur - open cursor to the database
+    conn - open connection to the database
+    args - argparse.Namespace holding the options of build_arg_parser
+    filepath - directory string in which to look for song files
+    dsn - str, connection string the worker processes connect with
+    """
+    if args.defer_indexes:
+        run_index_queries(cur, conn, drop_index_queries, 'index_drop')
+
+    reader = None
+    if args.pipeline > 0:
+        song_func, batch_size = write_song_columns, args.song_batch or 1
+        reader = read_song_files
+    elif args.song_batch > 0:
+        song_func, batch_size = process_song_batch, args.song_batch
+    else:
+        song_func, batch_size = process_song_file, None
+
+    process_data(cur, conn, filepath=filepath, func=song_func,
+                 workers=args.workers, batch_size=batch_size, manifest=True,
+                 full_refresh=args.full_refresh, dsn=dsn, reader=reader,
+                 pipeline=args.pipeline, commit_files=args.commit_files,
+                 commit_rows=args.commit_rows,
+                 retry_quarantine=args.retry_quarantine,
+                 **discovery_options(args))
+
+    # the log pass resolves songplays through the lookup indexes
+    if args.defer_indexes:
+        run_index_queries(cur, conn, lookup_index_queries, 'index_build')
+
+    metrics.flush('song_pass')
+
+
+def run_log_pass(cur, conn, args, filepath='data/log_data',
+                 dsn=SPARKIFY_DSN):
+    """Loads the time, users and songplays tables from a tree of log files.
+    The song pass must have run first.
+
+    Keyword arguments:
+    cur - open cursor to the database
+    conn - open connection to the database
+    args - argparse.Namespace holding the options of build_arg_parser
+    filepath - directory string in which to look for log files
+    dsn - str, connection string the worker processes connect with
+
+    Returns the SongCache used to resolve songplays, or None.
+    """
+    # the song dimension is complete once the song pass is done
+    cache = None
+    if args.cache_mb > 0:
+        cache = SongCache(int(args.cache_mb * 2 ** 20))
+        cache.load(cur)
+
+    # a pipelined load parses files on a reader thread and only hands the
+    # DataFrame of NextSong events to the writing function
+    reader = None
+    if args.chunk_size > 0:
+        log_func = functools.partial(process_log_file_stream,
+                                     chunksize=args.chunk_size)
+    elif args.pipeline > 0:
+        reader = read_log_file
+        log_func = load_log_df_bulk if args.bulk else load_log_df
+    elif args.bulk:
+        log_func = process_log_file_bulk
+    else:
+        log_func = process_log_file
+    # loads create the monthly partitions they need
+    partitioned = is_partitioned(cur, conn, 'songplays')
+
+    log_func = functools.partial(log_func, cache=cache,
+                                 partitioned=partitioned)
+    process_data(cur, conn, filepath=filepath, func=log_func,
+                 workers=args.workers, manifest=True,
+                 full_refresh=args.full_refresh, dsn=dsn, reader=reader,
+                 pipeline=args.pipeline, commit_files=args.commit_files,
+                 commit_rows=args.commit_rows,
+                 retry_quarantine=args.retry_quarantine,
+                 **discovery_options(args))
+
+    if args.defer_indexes:
+        run_index_queries(cur, conn, analytic_index_queries, 'index_build')
+
+    metrics.flush('log_pass')
+    return cache
 
 
 def main():
@@ -173,16 +1423,36 @@ def main():
     Connects to the data base and calls the functions to populate it with song,
     artist and songplays data.
     """
+    parser = build_arg_parser()
+    parser.add_argument('--profile', metavar='PATH', nargs='?',
+                        const='etl.prof',
+                        help='run under cProfile and dump the stats to PATH '
+                             '(default etl.prof), worker processes are not '
+                             'profiled')
+    args = parser.parse_args()
+    check_args(parser, args)
+    metrics.configure(args.metrics)
+
+    backend = get_backend(args.backend, path=args.duckdb_path)
     try:
-        conn = psycopg2.connect(
-            "host=127.0.0.1 dbname=sparkifydb user=student password=student")
-        cur = conn.cursor()
+        conn = backend.connect()
     except Exception as e:
         print('Error connecting to the sparkify database')
         print(e)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    cache = backend.load(conn, args, *source_paths(args))
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print('Profile written to {}'.format(args.profile))
+
+    if cache is not None:
+        cache.report()
 
     conn.close()
 
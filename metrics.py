@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""This module is used as an import for the etl and benchmark modules. It
+records per-stage instrumentation of an etl run (wall time, rows in and out,
+database statements and bytes read) and writes it to a JSON-lines log.
+
+Dependencies: None
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import os
+import json
+import time
+import threading
+import psycopg2.extensions
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# path of the JSON-lines log, stage totals are only kept in memory when None
+log_path = None
+
+# stage name -> running totals since the last flush
+totals = OrderedDict()
+
+# the reader thread of a pipelined load records stages alongside the writer
+totals_lock = threading.Lock()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the statements it sends to the database, in total
+    and per thread."""
+
+    round_trips = 0
+    thread_counts = threading.local()
+
+    @staticmethod
+    def count(statements):
+        CountingCursor.round_trips += statements
+        counts = CountingCursor.thread_counts
+        counts.round_trips = thread_round_trips() + statements
+
+    def execute(self, query, vars=None):
+        CountingCursor.count(1)
+        return super(CountingCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        CountingCursor.count(len(vars_list))
+        return super(CountingCursor, self).executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        CountingCursor.count(1)
+        return super(CountingCursor, self).copy_expert(sql, file, size)
+
+
+def thread_round_trips():
+    """Returns the statements sent by CountingCursors of the calling
+    thread."""
+    return getattr(CountingCursor.thread_counts, 'round_trips', 0)
+
+
+class Stage(object):
+    """Measurements of one run of a stage. rows_in, rows_out and bytes_read
+    are filled in by the instrumented code."""
+
+    def __init__(self, name, rows_in=0, bytes_read=0):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = 0
+        self.bytes_read = bytes_read
+
+
+def configure(path):
+    """Sets the JSON-lines file that flush appends stage records to.
+
+    Keyword arguments:
+    path - str, location of the metrics log, or None to disable it
+    """
+    global log_path
+    log_path = path
+
+
+@contextmanager
+def stage(name, rows_in=0, bytes_read=0):
+    """Times the body of a with statement and adds it to the totals of a
+    stage, along with the statements run on a CountingCursor meanwhile.
+
+    Keyword arguments:
+    name - str, name of the stage
+    rows_in - int, number of rows going into the stage
+    bytes_read - int, number of bytes read from disk by the stage
+    """
+    record = Stage(name, rows_in, bytes_read)
+    statements = thread_round_trips()
+    start = time.time()
+    try:
+        yield record
+    finally:
+        elapsed = time.time() - start
+        with totals_lock:
+            total = totals.setdefault(name, {
+                'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0,
+                'statements': 0, 'bytes_read': 0})
+            total['calls'] += 1
+            total['seconds'] += elapsed
+            total['rows_in'] += record.rows_in
+            total['rows_out'] += record.rows_out
+            total['statements'] += thread_round_trips() - statements
+            total['bytes_read'] += record.bytes_read
+
+
+def flush(label):
+    """Appends one record per stage to the metrics log and resets the totals.
+
+    Keyword arguments:
+    label - str, what the totals cover, e.g. the pass or shard of files
+    """
+    with totals_lock:
+        records = list(totals.items())
+        totals.clear()
+
+    if log_path is not None and records:
+        lines = ''.join(json.dumps(OrderedDict(
+            [('label', label), ('pid', os.getpid()), ('stage', name),
+             ('timestamp', time.time())] + list(total.items()))) + '\n'
+            for name, total in records)
+
+        # a single O_APPEND write keeps the lines of worker processes whole
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode('utf-8'))
+        finally:
+            os.close(fd)
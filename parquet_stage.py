@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module converts the raw song_data and log_data json trees into a
+staging layer of partitioned Parquet files with typed columns, so repeated
+loads read compact columnar data instead of parsing json. Songs are
+partitioned by the first letter of their title and events by year and month:
+
+    <dest>/songs/letter=A/part-00000.parquet
+    <dest>/events/year=2018/month=11/part-00000.parquet
+
+Conversion is incremental. The size and mtime of every converted json file
+is kept in <dest>/_converted.json and only new or changed files are read on
+the next run, their rows going to new part files. Rows of a changed file are
+then staged twice, which the ON CONFLICT clauses of the load absorb.
+
+Dependencies: pyarrow (optional), which pandas uses to read and write the
+Parquet files, and zstandard (optional) to convert .zst compressed files.
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import os
+import json
+import glob
+import argparse
+import importlib.util
+import pandas as pd
+import metrics
+import discovery
+import readers
+
+PARQUET_DIR = 'data/parquet'
+STATE_FILE = '_converted.json'
+
+# column types of the staged files, the json trees leave them to inference.
+# Integers are nullable so missing values stay missing for the validation
+SONG_TYPES = (('song_id', str), ('title', str), ('artist_id', str),
+              ('year', 'Int64'), ('duration', 'float64'),
+              ('artist_name', str), ('artist_location', str),
+              ('artist_latitude', 'float64'), ('artist_longitude', 'float64'),
+              ('num_songs', 'Int64'))
+EVENT_TYPES = (('artist', str), ('auth', str), ('firstName', str),
+               ('gender', str), ('itemInSession', 'Int64'),
+               ('lastName', str), ('length', 'float64'), ('level', str),
+               ('location', str), ('method', str), ('page', str),
+               ('registration', 'float64'), ('sessionId', 'Int64'),
+               ('song', str), ('status', 'Int64'), ('ts', 'Int64'),
+               ('userAgent', str), ('userId', str))
+
+# columns the etl reads back from the staged files
+SONG_READ_COLUMNS = ['song_id', 'title', 'artist_id', 'year', 'duration',
+                     'artist_name', 'artist_location', 'artist_latitude',
+                     'artist_longitude']
+EVENT_READ_COLUMNS = ['artist', 'firstName', 'gender', 'itemInSession',
+                      'lastName', 'length', 'level', 'location', 'page',
+                      'sessionId', 'song', 'ts', 'userAgent', 'userId']
+
+
+def check_engine():
+    """Raises an ImportError when pandas has no Parquet engine to use."""
+    if importlib.util.find_spec('pyarrow') is None:
+        raise ImportError('The Parquet staging layer needs the pyarrow '
+                          'package, install it with: pip install pyarrow')
+
+
+def is_parquet(filepath):
+    """Returns whether a data file is a staged Parquet file."""
+    return filepath.endswith('.parquet')
+
+
+def from_nullable(df):
+    """Converts the nullable integer columns of a staged DataFrame to int64,
+    or to objects holding None when they have missing values, which the
+    database driver can't adapt as pd.NA.
+
+    Keyword arguments:
+    df - DataFrame read from a staged file
+    """
+    for column, dtype in df.dtypes.items():
+        if dtype == 'Int64':
+            values = df[column]
+            if values.hasnans:
+                df[column] = values.astype(object).where(values.notnull(),
+                                                         None)
+            else:
+                df[column] = values.astype('int64')
+
+    return df
+
+
+def read_parquet(filepath, columns):
+    """Reads the projected columns of a staged Parquet file.
+
+    Keyword arguments:
+    filepath - str, location of the Parquet file
+    columns - list of the column names to read
+
+    Returns a DataFrame holding only the given columns.
+    """
+    with metrics.stage('parquet_read',
+                       bytes_read=os.path.getsize(filepath)) as stage:
+        df = from_nullable(pd.read_parquet(filepath, columns=columns))
+        stage.rows_out = len(df)
+
+    return df
+
+
+def iter_parquet(filepath, columns, chunksize):
+    """Yields the projected columns of a staged Parquet file in DataFrames of
+    up to chunksize rows, without reading the whole file into memory.
+
+    Keyword arguments:
+    filepath - str, location of the Parquet file
+    columns - list of the column names to read
+    chunksize - int, number of rows per DataFrame
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(filepath)
+    for batch in parquet_file.iter_batches(batch_size=chunksize,
+                                           columns=columns):
+        yield from_nullable(batch.to_pandas())
+
+
+def apply_types(df, types):
+    """Casts the columns of a DataFrame parsed from json to the staged
+    column types, adding missing columns as nulls. Missing strings are
+    stored as nulls and not as the text 'None'.
+
+    Keyword arguments:
+    df - DataFrame parsed from json files
+    types - tuple of (column name, type) pairs
+
+    Returns a DataFrame with exactly the typed columns, in order.
+    """
+    typed = pd.DataFrame(index=df.index)
+    for column, dtype in types:
+        values = df[column] if column in df else pd.Series(None,
+                                                           index=df.index)
+        if dtype is str:
+            missing = values.isnull()
+            values = values.astype(str).where(~missing, None)
+            if column == 'userId':
+                # logged out events have an empty userId
+                values = values.where(values != '', None)
+        elif dtype == 'Int64':
+            # values that aren't whole numbers are staged as missing
+            values = pd.to_numeric(values, errors='coerce')
+            values = values.where(values % 1 == 0)
+        values = values.astype(object if dtype is str else dtype)
+        typed[column] = values
+
+    return typed
+
+
+def load_state(dest):
+    """Returns the dict of json file -> [size, mtime] converted so far.
+
+    Keyword arguments:
+    dest - str, root directory of the staging layer
+    """
+    path = os.path.join(dest, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(dest, state):
+    """Atomically replaces the record of converted json files.
+
+    Keyword arguments:
+    dest - str, root directory of the staging layer
+    state - dict of json file -> [size, mtime]
+    """
+    path = os.path.join(dest, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def find_new_files(src, state):
+    """Lists the json files under src that are not converted yet or changed
+    since they were.
+
+    Keyword arguments:
+    src - str, root directory of a json tree
+    state - dict of json file -> [size, mtime] converted so far
+
+    Returns a sorted list of absolute file paths.
+    """
+    new_files = []
+    for datafile in discovery.iter_data_files(src, sort=True):
+        stat = os.stat(datafile)
+        if state.get(datafile) != [stat.st_size, stat.st_mtime]:
+            new_files.append(datafile)
+
+    return new_files
+
+
+def write_partitions(df, dest, keys):
+    """Writes a DataFrame as one new part file per partition.
+
+    Keyword arguments:
+    df - DataFrame to write, holding the partition key columns
+    dest - str, directory of the partitioned table
+    keys - list of the partition key column names, which are dropped from
+           the files and encoded in their directory names instead
+
+    Returns the number of part files written.
+    """
+    written = 0
+    for values, part in df.groupby(keys, sort=True):
+        values = values if isinstance(values, tuple) else (values,)
+        directory = os.path.join(dest, *('{}={}'.format(key, value)
+                                         for key, value in zip(keys, values)))
+        os.makedirs(directory, exist_ok=True)
+
+        number = len(glob.glob(os.path.join(directory, 'part-*.parquet')))
+        path = os.path.join(directory, 'part-{:05d}.parquet'.format(number))
+        part.drop(columns=keys).to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+        written += 1
+
+    return written
+
+
+def convert_songs(filepaths, dest):
+    """Converts song files to Parquet, partitioned by the upper cased first
+    letter of the title ('_' for titles that don't start with a letter).
+
+    Keyword arguments:
+    filepaths - list of song file locations in json format
+    dest - str, directory of the staged songs
+
+    Returns the number of song records converted.
+    """
+    records = []
+    with metrics.stage('song_parse') as stage:
+        for filepath in filepaths:
+            for line in readers.iter_lines(filepath):
+                stage.bytes_read += len(line)
+                records.append(json.loads(line))
+        stage.rows_out = len(records)
+
+    if not records:
+        return 0
+
+    with metrics.stage('parquet_write', rows_in=len(records)) as stage:
+        df = apply_types(pd.DataFrame(records), SONG_TYPES)
+        first = df.title.fillna('').str[:1].str.upper()
+        df['letter'] = first.where(first.str.isalpha(), '_')
+        write_partitions(df, dest, ['letter'])
+        stage.rows_out = len(df)
+
+    return len(df)
+
+
+def convert_logs(filepaths, dest):
+    """Converts log files to Parquet, partitioned by the year and month of
+    the event timestamps.
+
+    Keyword arguments:
+    filepaths - list of log file locations in json format
+    dest - str, directory of the staged events
+
+    Returns the number of events converted.
+    """
+    frames = []
+    for filepath in filepaths:
+        with metrics.stage('log_parse',
+                           bytes_read=os.path.getsize(filepath)) as stage:
+            frames.append(readers.read_json_frame(filepath))
+            stage.rows_out = len(frames[-1])
+
+    if not frames:
+        return 0
+
+    with metrics.stage('parquet_write') as stage:
+        df = apply_types(pd.concat(frames, ignore_index=True), EVENT_TYPES)
+        stage.rows_in = len(df)
+        # events without a ts are staged under year=0/month=0 and rejected
+        # by the validation of the load, like they are from json
+        months = pd.to_datetime(df.ts, unit='ms')
+        df['year'] = months.dt.year.fillna(0).astype('int64')
+        df['month'] = months.dt.month.fillna(0).astype('int64')
+        write_partitions(df, dest, ['year', 'month'])
+        stage.rows_out = len(df)
+
+    return len(df)
+
+
+def stage_data(song_src='data/song_data', log_src='data/log_data',
+               dest=PARQUET_DIR):
+    """Converts the json files that are new since the last run into the
+    Parquet staging layer.
+
+    Keyword arguments:
+    song_src - str, root directory of the song files
+    log_src - str, root directory of the log files
+    dest - str, root directory of the staging layer
+
+    Returns a tuple of the directories of the staged songs and events.
+    """
+    check_engine()
+    os.makedirs(dest, exist_ok=True)
+    state = load_state(dest)
+    song_dest = os.path.join(dest, 'songs')
+    event_dest = os.path.join(dest, 'events')
+
+    for src, table_dest, convert in ((song_src, song_dest, convert_songs),
+                                     (log_src, event_dest, convert_logs)):
+        new_files = find_new_files(src, state)
+        rows = convert(new_files, table_dest)
+        print('{} new files in {} staged as {} rows'.format(
+            len(new_files), src, rows))
+
+        # record the files once their part files are written
+        for datafile in new_files:
+            stat = os.stat(datafile)
+            state[datafile] = [stat.st_size, stat.st_mtime]
+        save_state(dest, state)
+
+    return song_dest, event_dest
+
+
+def main():
+    """Entry point to this module. Stages the sample json trees."""
+    parser = argparse.ArgumentParser(
+        description='Convert the json trees into the Parquet staging layer')
+    parser.add_argument('--song-data', default='data/song_data',
+                        help='root directory of the song files')
+    parser.add_argument('--log-data', default='data/log_data',
+                        help='root directory of the log files')
+    parser.add_argument('--dest', default=PARQUET_DIR,
+                        help='root directory of the staging layer')
+    args = parser.parse_args()
+
+    stage_data(args.song_data, args.log_data, args.dest)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""This module is used as an import for the etl and parquet_stage modules. It
+reads newline delimited json data files whether they are plain (.json,
+.jsonl), gzip (.gz) or zstandard (.zst) compressed. Compressed files are
+decompressed as a stream without temporary files. The line and chunk
+readers split large plain files in place through mmap, instead of reading
+them through a buffer.
+
+Dependencies: zstandard (optional) for .zst files.
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import io
+import os
+import gzip
+import mmap
+import itertools
+import pandas as pd
+
+# file name patterns of the json data files this module can read
+JSON_PATTERNS = ('*.json', '*.jsonl', '*.json.gz', '*.jsonl.gz',
+                 '*.json.zst', '*.jsonl.zst')
+
+# plain files from this size on are split through mmap by iter_lines
+MMAP_MIN_BYTES = 16 * 2 ** 20
+
+
+def compression(filepath):
+    """Returns 'gz' or 'zst' for a compressed data file, None otherwise."""
+    for suffix in ('gz', 'zst'):
+        if filepath.endswith('.' + suffix):
+            return suffix
+    return None
+
+
+def open_compressed(filepath):
+    """Returns a buffered binary stream of the decompressed content of a .gz
+    or .zst file.
+
+    Keyword arguments:
+    filepath - str, location of the data file
+    """
+    if compression(filepath) == 'gz':
+        return gzip.open(filepath, 'rb')
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Reading .zst files needs the zstandard package, '
+                          'install it with: pip install zstandard')
+    reader = zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'),
+                                                        closefd=True)
+    return io.BufferedReader(reader)
+
+
+def iter_lines(filepath):
+    """Yields the non blank lines of a data file as bytes, decompressing it
+    as it goes. Large plain files are memory-mapped and split in place.
+
+    Keyword arguments:
+    filepath - str, location of the data file
+    """
+    if compression(filepath) is None:
+        if os.path.getsize(filepath) >= MMAP_MIN_BYTES:
+            with open(filepath, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for line in iter(mm.readline, b''):
+                        if line.strip():
+                            yield line
+            return
+        stream = open(filepath, 'rb')
+    else:
+        stream = open_compressed(filepath)
+
+    with stream:
+        for line in stream:
+            if line.strip():
+                yield line
+
+
+def read_json_frame(filepath):
+    """Reads a newline delimited json data file into a DataFrame, with the
+    same type inference as pd.read_json on a plain file. Plain files are
+    not memory-mapped here: pd.read_json reads and splits its input into
+    copies either way, so a mapping would not lower the peak memory.
+
+    Keyword arguments:
+    filepath - str, location of the data file
+    """
+    if compression(filepath) is None:
+        return pd.read_json(filepath, lines=True)
+
+    with open_compressed(filepath) as f:
+        return pd.read_json(f, lines=True)
+
+
+def iter_json_frames(filepath, chunksize):
+    """Yields the records of a newline delimited json data file in
+    DataFrames of up to chunksize rows, indexed as if the whole file had
+    been read at once.
+
+    Keyword arguments:
+    filepath - str, location of the data file
+    chunksize - int, number of records per DataFrame
+    """
+    lines = iter_lines(filepath)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(lines, chunksize))
+        if not chunk:
+            return
+        df = pd.read_json(io.BytesIO(b''.join(chunk)), lines=True)
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""This module is used as an import for the etl module. It holds an in-memory
+index of the songs and artists dimension so that log files can resolve the
+song and artist id's of their events without asking the database each time.
+
+Dependencies: The songs and artists tables must be populated (i.e. the song
+pass of the etl module must have run) before the cache is loaded.
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import sys
+from collections import OrderedDict
+from sql_queries import song_cache_select
+
+# rough per entry cost of the OrderedDict slot and its linked list node
+ENTRY_OVERHEAD = 120
+
+
+class SongCache(object):
+    """LRU cache from (title, artist name, duration) to (song_id, artist_id).
+
+    Strings are interned so that repeated titles, artist names and id's are
+    only stored once. Once the estimated size of the entries goes above
+    max_bytes the least recently used entries are evicted and looking them up
+    again is a miss, which the caller resolves against the database.
+    """
+
+    def __init__(self, max_bytes):
+        """Keyword arguments:
+        max_bytes - int, memory cap for the cache entries in bytes
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(title, artist, duration):
+        return (sys.intern(title), sys.intern(artist), float(duration))
+
+    @staticmethod
+    def _size(key, value):
+        strings = [s for s in key[:2] + value if s is not None]
+        return (ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(value) +
+                sys.getsizeof(key[2]) + sum(sys.getsizeof(s) for s in strings))
+
+    def get(self, key):
+        """Returns the (song_id, artist_id) of a (title, artist, duration)
+        key, or None on a miss. A hit marks the entry as recently used.
+
+        Keyword arguments:
+        key - tuple, (title, artist name, duration)
+        """
+        key = self._key(*key)
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Adds an entry, evicting the least recently used entries if the
+        cache grows over its memory cap. Unknown songs can be cached with a
+        value of (None, None) so they aren't looked up again.
+
+        Keyword arguments:
+        key - tuple, (title, artist name, duration)
+        value - tuple, (song_id, artist_id)
+        """
+        key = self._key(*key)
+        value = tuple(None if v is None else sys.intern(v) for v in value)
+        if key in self._entries:
+            self.nbytes -= self._size(key, self._entries.pop(key))
+
+        self._entries[key] = value
+        self.nbytes += self._size(key, value)
+
+        while self.nbytes > self.max_bytes and self._entries:
+            old_key, old_value = self._entries.popitem(last=False)
+            self.nbytes -= self._size(old_key, old_value)
+            self.evictions += 1
+
+    def load(self, cur):
+        """Fills the cache from the songs and artists tables.
+
+        Keyword arguments:
+        cur - Open database cursor
+        """
+        cur.execute(song_cache_select)
+        for title, artist, duration, song_id, artist_id in cur:
+            if title is None or artist is None or duration is None:
+                continue
+            self.put((title, artist, duration), (song_id, artist_id))
+
+    def counters(self):
+        """Returns the (hits, misses, evictions) counters of the cache."""
+        return (self.hits, self.misses, self.evictions)
+
+    def add_counters(self, counters):
+        """Adds the counters of another copy of the cache, such as the one
+        of a worker process, to these.
+
+        Keyword arguments:
+        counters - tuple, (hits, misses, evictions) to add
+        """
+        hits, misses, evictions = counters
+        self.hits += hits
+        self.misses += misses
+        self.evictions += evictions
+
+    def report(self):
+        """Prints the hit/miss counters and size of the cache."""
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        print('Song cache: {} hits, {} misses ({:.1f}% hit rate), '
+              '{} evictions, {} entries, {:.1f} of {:.1f} MB used'.format(
+                  self.hits, self.misses, rate, self.evictions,
+                  len(self._entries), self.nbytes / 2.0 ** 20,
+                  self.max_bytes / 2.0 ** 20))
@@ -17,24 +17,42 @@ __status__ = "Production"
 # DROP TABLES - SQL used to drop tables in the sparkify database
 
 songplay_table_drop = "DROP TABLE IF EXISTS songplays"
+songplay_sequence_drop = "DROP SEQUENCE IF EXISTS songplay_id_seq"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS load_manifest"
+quarantine_table_drop = "DROP TABLE IF EXISTS load_quarantine"
+song_reject_drop = "DROP TABLE IF EXISTS song_rejects"
+event_reject_drop = "DROP TABLE IF EXISTS event_rejects"
+load_version_drop = "DROP TABLE IF EXISTS load_version"
+hour_rollup_drop = "DROP TABLE IF EXISTS plays_by_hour"
+level_rollup_drop = "DROP TABLE IF EXISTS plays_by_level"
+artist_rollup_drop = "DROP TABLE IF EXISTS plays_by_artist"
 
 # CREATE TABLES - DDL used to create the tables in the sparkify database
 
+# songplay ids come from a sequence, each connection reserves a block of
+# CACHE ids at a time so parallel loaders don't contend on it
+songplay_sequence_create = ("""CREATE SEQUENCE IF NOT EXISTS songplay_id_seq
+                                            CACHE 1000
+""")
+
 songplay_table_create = ("""CREATE TABLE IF NOT EXISTS songplays (
-                                                    songplay_id INT NOT NULL UNIQUE,
+                                                    songplay_id BIGINT NOT NULL UNIQUE
+                                                        DEFAULT nextval('songplay_id_seq'),
                                                     start_time BIGINT,
                                                     user_id INT,
                                                     level TEXT,
                                                     song_id TEXT,
                                                     artist_id TEXT,
                                                     session_id INT,
+                                                    item_in_session INT,
                                                     location TEXT,
                                                     user_agent TEXT,
-                                                    PRIMARY KEY(songplay_id)
+                                                    PRIMARY KEY(songplay_id),
+                                                    UNIQUE(session_id, item_in_session, start_time)
                                                     )
 """)
 
@@ -44,6 +62,7 @@ user_table_create = ("""CREATE TABLE IF NOT EXISTS users (
                                             last_name TEXT,
                                             gender CHAR,
                                             level TEXT,
+                                            last_seen BIGINT,
                                             PRIMARY KEY(user_id)
                                             )
 """)
@@ -69,26 +88,205 @@ artist_table_create = ("""CREATE TABLE IF NOT EXISTS artists (
 """)
 
 time_table_create = ("""CREATE TABLE IF NOT EXISTS time (
-                                            start_time BIGINT,
+                                            start_time BIGINT NOT NULL UNIQUE,
                                             hour INT,
                                             day INT,
                                             week INT,
                                             month INT,
                                             year INT,
-                                            weekday INT
+                                            weekday INT,
+                                            PRIMARY KEY(start_time)
                                           )
 """)
 
+manifest_table_create = ("""CREATE TABLE IF NOT EXISTS load_manifest (
+                                            path TEXT NOT NULL,
+                                            size BIGINT,
+                                            mtime DOUBLE PRECISION,
+                                            content_hash TEXT,
+                                            loaded_at TIMESTAMP DEFAULT now(),
+                                            PRIMARY KEY(path)
+                                            )
+""")
+
+quarantine_table_create = ("""CREATE TABLE IF NOT EXISTS load_quarantine (
+                                            path TEXT NOT NULL,
+                                            error TEXT,
+                                            attempts INT NOT NULL DEFAULT 1,
+                                            failed_at TIMESTAMP DEFAULT now(),
+                                            PRIMARY KEY(path)
+                                            )
+""")
+
+# the single row of load_version is bumped by every etl commit that loads
+# rows, the analytics module compares it to drop cached results
+load_version_create = ("""CREATE TABLE IF NOT EXISTS load_version (
+                                            id INT NOT NULL DEFAULT 1 CHECK (id = 1),
+                                            version BIGINT NOT NULL,
+                                            bumped_at TIMESTAMP NOT NULL DEFAULT now(),
+                                            PRIMARY KEY(id)
+                                            )
+""")
+
+# CREATE REJECT TABLES - DDL of the tables holding the records that failed
+# the validation of the etl, with the file they came from and the reasons
+
+song_reject_create = ("""CREATE TABLE IF NOT EXISTS song_rejects (
+                                            reject_id BIGSERIAL,
+                                            source TEXT,
+                                            reason TEXT NOT NULL,
+                                            record TEXT,
+                                            rejected_at TIMESTAMP DEFAULT now(),
+                                            PRIMARY KEY(reject_id)
+                                            )
+""")
+
+event_reject_create = ("""CREATE TABLE IF NOT EXISTS event_rejects (
+                                            reject_id BIGSERIAL,
+                                            source TEXT,
+                                            reason TEXT NOT NULL,
+                                            record TEXT,
+                                            rejected_at TIMESTAMP DEFAULT now(),
+                                            PRIMARY KEY(reject_id)
+                                            )
+""")
+
+# CREATE ROLLUP TABLES - DDL of the summary tables of songplays maintained
+# by the etl. Hours and days are epoch ms like start_time
+
+hour_rollup_create = ("""CREATE TABLE IF NOT EXISTS plays_by_hour (
+                                            hour_start BIGINT NOT NULL,
+                                            plays BIGINT NOT NULL,
+                                            PRIMARY KEY(hour_start)
+                                            )
+""")
+
+level_rollup_create = ("""CREATE TABLE IF NOT EXISTS plays_by_level (
+                                            day_start BIGINT NOT NULL,
+                                            level TEXT NOT NULL,
+                                            plays BIGINT NOT NULL,
+                                            PRIMARY KEY(day_start, level)
+                                            )
+""")
+
+artist_rollup_create = ("""CREATE TABLE IF NOT EXISTS plays_by_artist (
+                                            artist_id TEXT NOT NULL,
+                                            plays BIGINT NOT NULL,
+                                            PRIMARY KEY(artist_id)
+                                            )
+""")
+
+# CREATE PARTITIONED TABLES - DDL used instead of the songplays and time DDL
+# above to range partition the tables by month of start_time (Postgres 11+).
+# Partitions are created on demand by the etl with partition_create
+
+songplay_table_create_partitioned = ("""CREATE TABLE IF NOT EXISTS songplays (
+                                                    songplay_id BIGINT NOT NULL
+                                                        DEFAULT nextval('songplay_id_seq'),
+                                                    start_time BIGINT NOT NULL,
+                                                    user_id INT,
+                                                    level TEXT,
+                                                    song_id TEXT,
+                                                    artist_id TEXT,
+                                                    session_id INT,
+                                                    item_in_session INT,
+                                                    location TEXT,
+                                                    user_agent TEXT,
+                                                    PRIMARY KEY(songplay_id, start_time),
+                                                    UNIQUE(session_id, item_in_session, start_time)
+                                                    ) PARTITION BY RANGE (start_time)
+""")
+
+time_table_create_partitioned = ("""CREATE TABLE IF NOT EXISTS time (
+                                            start_time BIGINT NOT NULL,
+                                            hour INT,
+                                            day INT,
+                                            week INT,
+                                            month INT,
+                                            year INT,
+                                            weekday INT,
+                                            PRIMARY KEY(start_time)
+                                          ) PARTITION BY RANGE (start_time)
+""")
+
+# PARTITIONS - SQL templates used to manage the monthly partitions. Table and
+# partition names are formatted in by the caller, never user input
+
+# the table is resolved through the search_path, see SCHEMA SWAP below
+partitioned_table_select = ("""SELECT count(*) > 0 FROM pg_partitioned_table p
+       WHERE p.partrelid = to_regclass(%s)
+""")
+
+# the partitions of a list that don't exist yet, in the order given
+partitions_missing_select = ("""SELECT name FROM unnest(%s::TEXT[])
+                                  WITH ORDINALITY AS p(name, n)
+                                WHERE to_regclass(name) IS NULL
+                                ORDER BY n
+""")
+
+partition_lock = "SELECT pg_advisory_xact_lock(hashtext(%s))"
+
+partition_create = ("""CREATE TABLE IF NOT EXISTS {partition}
+                                PARTITION OF {table}
+                                FOR VALUES FROM ({start}) TO ({end})
+""")
+
+partition_detach = "ALTER TABLE {table} DETACH PARTITION {partition}"
+
+# SCHEMA SWAP - SQL used by create_tables to reload into a staging schema and
+# swap it with the live public schema. Schema and table names are formatted
+# in by the caller, never user input
+
+schema_exists = "SELECT count(*) > 0 FROM pg_namespace WHERE nspname = %s"
+schema_create = "CREATE SCHEMA IF NOT EXISTS {schema}"
+schema_grant = "GRANT USAGE ON SCHEMA {schema} TO PUBLIC"
+schema_rename = "ALTER SCHEMA {schema} RENAME TO {name}"
+schema_drop = "DROP SCHEMA IF EXISTS {schema} CASCADE"
+schema_tables_select = ("""SELECT tablename FROM pg_tables
+       WHERE schemaname = %s
+       ORDER BY tablename
+""")
+schema_tables_truncate = "TRUNCATE {tables}"
+table_analyze = "ANALYZE {schema}.{table}"
+songplay_sequence_restart = "ALTER SEQUENCE songplay_id_seq RESTART"
+
+# CREATE INDEXES - lookup indexes used by the etl to resolve songplays and
+# analytic indexes for queries on the fact table
+
+song_title_index_create = ("""CREATE INDEX IF NOT EXISTS songs_title_duration_idx
+                                ON songs (title, duration)
+""")
+artist_name_index_create = ("""CREATE INDEX IF NOT EXISTS artists_name_idx
+                                ON artists (name)
+""")
+songplay_start_time_index_create = ("""CREATE INDEX IF NOT EXISTS songplays_start_time_idx
+                                ON songplays (start_time)
+""")
+songplay_user_index_create = ("""CREATE INDEX IF NOT EXISTS songplays_user_id_idx
+                                ON songplays (user_id)
+""")
+songplay_song_index_create = ("""CREATE INDEX IF NOT EXISTS songplays_song_id_idx
+                                ON songplays (song_id)
+""")
+
+# DROP INDEXES - SQL used to drop the indexes above while bulk loading
+
+song_title_index_drop = "DROP INDEX IF EXISTS songs_title_duration_idx"
+artist_name_index_drop = "DROP INDEX IF EXISTS artists_name_idx"
+songplay_start_time_index_drop = "DROP INDEX IF EXISTS songplays_start_time_idx"
+songplay_user_index_drop = "DROP INDEX IF EXISTS songplays_user_id_idx"
+songplay_song_index_drop = "DROP INDEX IF EXISTS songplays_song_id_idx"
+
 # INSERT RECORDS SQL - SQL used to insert records into the sparkify database
 
 songplay_table_insert = ("""INSERT INTO songplays (
-                                                    songplay_id,
                                                     start_time,
                                                     user_id,
                                                     level,
                                                     song_id,
                                                     artist_id,
                                                     session_id,
+                                                    item_in_session,
                                                     location,
                                                     user_agent
                                                   )
@@ -97,16 +295,26 @@ songplay_table_insert = ("""INSERT INTO songplays (
                                                ON CONFLICT DO NOTHING
 """)
 
+# users keep the details of their latest event, last_seen being its ts, so a
+# file loaded after a later one doesn't overwrite the user's level
 user_table_insert = ("""INSERT INTO users (
                                             user_id,
                                             first_name,
                                             last_name,
                                             gender,
-                                            level
+                                            level,
+                                            last_seen
                                           )
                                         VALUES
-                                          (%s,%s,%s,%s,%s)
-                                        ON CONFLICT DO NOTHING
+                                          (%s,%s,%s,%s,%s,%s)
+                                        ON CONFLICT (user_id) DO UPDATE SET
+                                          first_name = EXCLUDED.first_name,
+                                          last_name = EXCLUDED.last_name,
+                                          gender = EXCLUDED.gender,
+                                          level = EXCLUDED.level,
+                                          last_seen = EXCLUDED.last_seen
+                                        WHERE users.last_seen IS NULL
+                                          OR users.last_seen <= EXCLUDED.last_seen
 """)
 
 song_table_insert = ("""INSERT INTO songs (
@@ -154,6 +362,135 @@ time_table_insert = ("""INSERT INTO time (
 
 """)
 
+manifest_table_upsert = ("""INSERT INTO load_manifest (
+                                            path,
+                                            size,
+                                            mtime,
+                                            content_hash
+                                          )
+                                        VALUES
+                                          (%s,%s,%s,%s)
+                                        ON CONFLICT (path) DO UPDATE SET
+                                          size = EXCLUDED.size,
+                                          mtime = EXCLUDED.mtime,
+                                          content_hash = EXCLUDED.content_hash,
+                                          loaded_at = now()
+""")
+
+quarantine_table_upsert = ("""INSERT INTO load_quarantine (
+                                            path,
+                                            error
+                                          )
+                                        VALUES
+                                          (%s,%s)
+                                        ON CONFLICT (path) DO UPDATE SET
+                                          error = EXCLUDED.error,
+                                          attempts = load_quarantine.attempts + 1,
+                                          failed_at = now()
+""")
+
+quarantine_delete = "DELETE FROM load_quarantine WHERE path = %s"
+
+# INSERT RECORDS IN BULK - multi-row versions of the inserts above, used with
+# psycopg2.extras.execute_values which expands the single VALUES %s
+
+song_table_insert_values = ("""INSERT INTO songs (
+                                            song_id,
+                                            title,
+                                            artist_id,
+                                            year,
+                                            duration
+                                          )
+                                        VALUES %s
+                                        ON CONFLICT DO NOTHING
+""")
+
+artist_table_insert_values = ("""INSERT INTO artists (
+                                                artist_id,
+                                                name,
+                                                location,
+                                                lattitude,
+                                                longitude
+                                              )
+                                            VALUES %s
+                                            ON CONFLICT DO NOTHING
+""")
+
+user_table_insert_values = ("""INSERT INTO users (
+                                            user_id,
+                                            first_name,
+                                            last_name,
+                                            gender,
+                                            level,
+                                            last_seen
+                                          )
+                                        VALUES %s
+                                        ON CONFLICT (user_id) DO UPDATE SET
+                                          first_name = EXCLUDED.first_name,
+                                          last_name = EXCLUDED.last_name,
+                                          gender = EXCLUDED.gender,
+                                          level = EXCLUDED.level,
+                                          last_seen = EXCLUDED.last_seen
+                                        WHERE users.last_seen IS NULL
+                                          OR users.last_seen <= EXCLUDED.last_seen
+""")
+
+time_table_insert_values = ("""INSERT INTO time (
+                                            start_time,
+                                            hour,
+                                            day,
+                                            week,
+                                            month,
+                                            year,
+                                            weekday
+                                         )
+                                      VALUES %s
+                                      ON CONFLICT DO NOTHING
+""")
+
+song_reject_insert_values = ("""INSERT INTO song_rejects (
+                                            source,
+                                            reason,
+                                            record
+                                          )
+                                        VALUES %s
+""")
+
+event_reject_insert_values = ("""INSERT INTO event_rejects (
+                                            source,
+                                            reason,
+                                            record
+                                          )
+                                        VALUES %s
+""")
+
+# LOAD VERSION - SQL used to bump the load version right before a commit and
+# to read it. The row lock is only held until that commit
+
+load_version_bump = ("""INSERT INTO load_version (id, version) VALUES (1, 1)
+                        ON CONFLICT (id) DO UPDATE SET
+                          version = load_version.version + 1,
+                          bumped_at = now()
+""")
+
+load_version_select = "SELECT version, bumped_at FROM load_version"
+
+# FIND LOADED FILES - SQL used to read the manifest of files already loaded
+
+manifest_select = ("""SELECT path, size, mtime, content_hash FROM load_manifest
+""")
+
+# FIND QUARANTINED FILES - SQL used to read the files that failed to load
+
+quarantine_select = "SELECT path FROM load_quarantine"
+
+# SAVEPOINTS - SQL used to roll back a single file that fails to load without
+# losing the other files of its transaction
+
+file_savepoint = "SAVEPOINT load_file"
+file_savepoint_release = "RELEASE SAVEPOINT load_file"
+file_savepoint_rollback = "ROLLBACK TO SAVEPOINT load_file"
+
 # FIND SONGS - SQL used to find the song and artist id's when doing an insert
 # into the songplays table
 
@@ -163,17 +500,484 @@ song_select = ("""SELECT s.song_id, a.artist_id
        WHERE s.title = %s AND a.name = %s AND s.duration = %s
 """)
 
+# FIND SONGS IN BULK - SQL used to resolve the song and artist id's of a
+# whole log file in one joined query instead of one song_select per event
+
+song_lookup_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS song_lookup_staging (
+                                            song TEXT,
+                                            artist TEXT,
+                                            length FLOAT
+                                          ) ON COMMIT DROP
+""")
+
+song_lookup_staging_truncate = "TRUNCATE song_lookup_staging"
+
+song_lookup_staging_copy = ("""COPY song_lookup_staging (
+                                            song,
+                                            artist,
+                                            length
+                                          )
+                                        FROM STDIN WITH CSV
+""")
+
+song_lookup_select = ("""SELECT l.song, l.artist, l.length, s.song_id, a.artist_id
+       FROM song_lookup_staging l
+       JOIN songs s ON s.title = l.song AND s.duration = l.length
+       JOIN artists a ON a.artist_id = s.artist_id AND a.name = l.artist
+""")
+
+# SONG CACHE - SQL used to load the whole songs/artists dimension into the
+# in-memory song cache of the etl module
+
+song_cache_select = ("""SELECT s.title, a.name, s.duration, s.song_id, a.artist_id
+       FROM songs s
+       JOIN artists a ON a.artist_id = s.artist_id
+""")
+
+# STAGING TABLES - temporary tables used by the bulk (COPY) load path. They
+# are dropped automatically when the transaction for a batch of log files
+# commits
+
+time_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS time_staging
+                                            (LIKE time) ON COMMIT DROP
+""")
+
+user_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS user_staging
+                                            (LIKE users) ON COMMIT DROP
+""")
+
+songplay_staging_create = ("""CREATE TEMP TABLE IF NOT EXISTS songplay_staging (
+                                                    start_time BIGINT,
+                                                    user_id INT,
+                                                    level TEXT,
+                                                    song_id TEXT,
+                                                    artist_id TEXT,
+                                                    session_id INT,
+                                                    item_in_session INT,
+                                                    location TEXT,
+                                                    user_agent TEXT
+                                                  ) ON COMMIT DROP
+""")
+
+staging_truncate = "TRUNCATE time_staging, user_staging, songplay_staging"
+
+# COPY RECORDS SQL - SQL used to stream DataFrames into the staging tables
+
+time_staging_copy = ("""COPY time_staging (
+                                            start_time,
+                                            hour,
+                                            day,
+                                            week,
+                                            month,
+                                            year,
+                                            weekday
+                                          )
+                                        FROM STDIN WITH CSV
+""")
+
+user_staging_copy = ("""COPY user_staging (
+                                            user_id,
+                                            first_name,
+                                            last_name,
+                                            gender,
+                                            level,
+                                            last_seen
+                                          )
+                                        FROM STDIN WITH CSV
+""")
+
+songplay_staging_copy = ("""COPY songplay_staging (
+                                                    start_time,
+                                                    user_id,
+                                                    level,
+                                                    song_id,
+                                                    artist_id,
+                                                    session_id,
+                                                    item_in_session,
+                                                    location,
+                                                    user_agent
+                                                  )
+                                                FROM STDIN WITH CSV
+""")
+
+# MERGE RECORDS SQL - SQL used to move staged rows into the sparkify tables
+
+time_table_merge = ("""INSERT INTO time (
+                                            start_time,
+                                            hour,
+                                            day,
+                                            week,
+                                            month,
+                                            year,
+                                            weekday
+                                          )
+                                        SELECT start_time, hour, day, week,
+                                               month, year, weekday
+                                        FROM time_staging
+                                        ON CONFLICT DO NOTHING
+""")
+
+user_table_merge = ("""INSERT INTO users (
+                                            user_id,
+                                            first_name,
+                                            last_name,
+                                            gender,
+                                            level,
+                                            last_seen
+                                          )
+                                        SELECT user_id, first_name, last_name,
+                                               gender, level, last_seen
+                                        FROM user_staging
+                                        ORDER BY user_id
+                                        ON CONFLICT (user_id) DO UPDATE SET
+                                          first_name = EXCLUDED.first_name,
+                                          last_name = EXCLUDED.last_name,
+                                          gender = EXCLUDED.gender,
+                                          level = EXCLUDED.level,
+                                          last_seen = EXCLUDED.last_seen
+                                        WHERE users.last_seen IS NULL
+                                          OR users.last_seen <= EXCLUDED.last_seen
+""")
+
+songplay_table_merge = ("""INSERT INTO songplays (
+                                                    start_time,
+                                                    user_id,
+                                                    level,
+                                                    song_id,
+                                                    artist_id,
+                                                    session_id,
+                                                    item_in_session,
+                                                    location,
+                                                    user_agent
+                                                  )
+                                                SELECT start_time, user_id,
+                                                       level, song_id,
+                                                       artist_id, session_id,
+                                                       item_in_session,
+                                                       location, user_agent
+                                                FROM songplay_staging
+                                                ON CONFLICT DO NOTHING
+                                                RETURNING start_time, level,
+                                                          artist_id
+""")
+
+# MERGE ROLLUPS SQL - SQL used with psycopg2.extras.execute_values to add the
+# partial aggregates of a batch of new songplays to the rollup tables
+
+hour_rollup_upsert = ("""INSERT INTO plays_by_hour (hour_start, plays)
+                                        VALUES %s
+                                        ON CONFLICT (hour_start) DO UPDATE SET
+                                          plays = plays_by_hour.plays +
+                                                  EXCLUDED.plays
+""")
+
+level_rollup_upsert = ("""INSERT INTO plays_by_level (day_start, level, plays)
+                                        VALUES %s
+                                        ON CONFLICT (day_start, level)
+                                        DO UPDATE SET
+                                          plays = plays_by_level.plays +
+                                                  EXCLUDED.plays
+""")
+
+artist_rollup_upsert = ("""INSERT INTO plays_by_artist (artist_id, plays)
+                                        VALUES %s
+                                        ON CONFLICT (artist_id) DO UPDATE SET
+                                          plays = plays_by_artist.plays +
+                                                  EXCLUDED.plays
+""")
+
+# REFRESH ROLLUPS SQL - SQL used to rebuild the rollup tables from the whole
+# songplays table. It runs on both Postgres and DuckDB
+
+rollup_truncate = "TRUNCATE {table}"
+
+hour_rollup_refresh = ("""INSERT INTO plays_by_hour
+       SELECT start_time - start_time % 3600000, count(*)
+       FROM songplays
+       GROUP BY 1
+""")
+
+level_rollup_refresh = ("""INSERT INTO plays_by_level
+       SELECT start_time - start_time % 86400000, level, count(*)
+       FROM songplays
+       WHERE level IS NOT NULL
+       GROUP BY 1, 2
+""")
+
+artist_rollup_refresh = ("""INSERT INTO plays_by_artist
+       SELECT artist_id, count(*)
+       FROM songplays
+       WHERE artist_id IS NOT NULL
+       GROUP BY 1
+""")
+
+# DUCKDB - SQL used by the embedded DuckDB backend, which creates the star
+# schema and loads it straight from the json trees. Paths are formatted in by
+# the backend
+
+duckdb_song_source = ("""read_json('{path}/**/*.json',
+                                    format='newline_delimited',
+                                    filename=true,
+                                    columns={{'song_id': 'VARCHAR',
+                                              'title': 'VARCHAR',
+                                              'artist_id': 'VARCHAR',
+                                              'year': 'INTEGER',
+                                              'duration': 'DOUBLE',
+                                              'artist_name': 'VARCHAR',
+                                              'artist_location': 'VARCHAR',
+                                              'artist_latitude': 'DOUBLE',
+                                              'artist_longitude': 'DOUBLE'}})
+""")
+
+duckdb_log_source = ("""read_json('{path}/**/*.json',
+                                   format='newline_delimited',
+                                   filename=true,
+                                   columns={{'artist': 'VARCHAR',
+                                             'firstName': 'VARCHAR',
+                                             'gender': 'VARCHAR',
+                                             'itemInSession': 'INTEGER',
+                                             'lastName': 'VARCHAR',
+                                             'length': 'DOUBLE',
+                                             'level': 'VARCHAR',
+                                             'location': 'VARCHAR',
+                                             'page': 'VARCHAR',
+                                             'sessionId': 'INTEGER',
+                                             'song': 'VARCHAR',
+                                             'ts': 'BIGINT',
+                                             'userAgent': 'VARCHAR',
+                                             'userId': 'VARCHAR'}})
+""")
+
+duckdb_table_queries = [
+    "CREATE SEQUENCE IF NOT EXISTS songplay_id_seq",
+    """CREATE TABLE IF NOT EXISTS songplays (
+                songplay_id BIGINT DEFAULT nextval('songplay_id_seq') PRIMARY KEY,
+                start_time BIGINT,
+                user_id INT,
+                level TEXT,
+                song_id TEXT,
+                artist_id TEXT,
+                session_id INT,
+                item_in_session INT,
+                location TEXT,
+                user_agent TEXT,
+                UNIQUE(session_id, item_in_session, start_time)
+                )
+    """,
+    """CREATE TABLE IF NOT EXISTS users (
+                user_id INT PRIMARY KEY,
+                first_name TEXT,
+                last_name TEXT,
+                gender CHAR,
+                level TEXT,
+                last_seen BIGINT
+                )
+    """,
+    """CREATE TABLE IF NOT EXISTS songs (
+                song_id TEXT PRIMARY KEY,
+                title TEXT,
+                artist_id TEXT,
+                year INT,
+                duration FLOAT8
+                )
+    """,
+    """CREATE TABLE IF NOT EXISTS artists (
+                artist_id TEXT PRIMARY KEY,
+                name TEXT,
+                location TEXT,
+                lattitude FLOAT8,
+                longitude FLOAT8
+                )
+    """,
+    """CREATE TABLE IF NOT EXISTS time (
+                start_time BIGINT PRIMARY KEY,
+                hour INT,
+                day INT,
+                week INT,
+                month INT,
+                year INT,
+                weekday INT
+                )
+    """,
+    hour_rollup_create,
+    level_rollup_create,
+    artist_rollup_create]
+
+duckdb_song_load = ("""INSERT INTO songs
+       SELECT DISTINCT ON (song_id) song_id, title, artist_id, year, duration
+       FROM {source}
+       WHERE filename NOT LIKE '%-checkpoint.json'
+       ON CONFLICT DO NOTHING
+""")
+
+duckdb_artist_load = ("""INSERT INTO artists
+       SELECT DISTINCT ON (artist_id) artist_id, artist_name, artist_location,
+              artist_latitude, artist_longitude
+       FROM {source}
+       WHERE filename NOT LIKE '%-checkpoint.json'
+       ON CONFLICT DO NOTHING
+""")
+
+duckdb_event_view = ("""CREATE OR REPLACE TEMP VIEW next_song_events AS
+       SELECT * FROM {source}
+       WHERE page = 'NextSong' AND filename NOT LIKE '%-checkpoint.json'
+""")
+
+duckdb_time_load = ("""INSERT INTO time
+       SELECT ts, hour(t), day(t), week(t), month(t), year(t), isodow(t) - 1
+       FROM (SELECT DISTINCT ts, epoch_ms(ts) AS t FROM next_song_events)
+       ON CONFLICT DO NOTHING
+""")
+
+duckdb_user_load = ("""INSERT INTO users
+       SELECT DISTINCT ON (userId) CAST(userId AS INT), firstName, lastName,
+              gender, level, ts
+       FROM next_song_events
+       ORDER BY userId, ts DESC
+       ON CONFLICT (user_id) DO UPDATE SET
+         first_name = EXCLUDED.first_name,
+         last_name = EXCLUDED.last_name,
+         gender = EXCLUDED.gender,
+         level = EXCLUDED.level,
+         last_seen = EXCLUDED.last_seen
+       WHERE users.last_seen IS NULL OR users.last_seen <= EXCLUDED.last_seen
+""")
+
+duckdb_songplay_load = ("""INSERT INTO songplays (start_time, user_id, level,
+                              song_id, artist_id, session_id,
+                              item_in_session, location, user_agent)
+       SELECT DISTINCT ON (e.sessionId, e.itemInSession, e.ts)
+              e.ts, CAST(e.userId AS INT), e.level, s.song_id, a.artist_id,
+              e.sessionId, e.itemInSession, e.location, e.userAgent
+       FROM next_song_events e
+       LEFT JOIN (songs s JOIN artists a ON a.artist_id = s.artist_id)
+         ON s.title = e.song AND a.name = e.artist AND s.duration = e.length
+       ON CONFLICT DO NOTHING
+""")
+
+# ANALYTICS - parameterized reports of the analytics module. Periods are
+# epoch ms bounds of start_time, start included and end excluded, and a NULL
+# bound leaves that side of the period open. Reports by hour of day and by
+# weekday read the plays_by_hour rollup, so their periods apply to whole hours
+
+top_songs_select = ("""SELECT s.title, a.name AS artist, COUNT(*) AS plays
+                       FROM songplays sp
+                       JOIN songs s ON s.song_id = sp.song_id
+                       JOIN artists a ON a.artist_id = s.artist_id
+                       WHERE (%(start)s::BIGINT IS NULL OR sp.start_time >= %(start)s)
+                         AND (%(end)s::BIGINT IS NULL OR sp.start_time < %(end)s)
+                       GROUP BY s.song_id, s.title, a.name
+                       ORDER BY plays DESC, s.title
+                       LIMIT %(limit)s
+""")
+
+top_artists_select = ("""SELECT a.name AS artist, COUNT(*) AS plays
+                         FROM songplays sp
+                         JOIN artists a ON a.artist_id = sp.artist_id
+                         WHERE (%(start)s::BIGINT IS NULL OR sp.start_time >= %(start)s)
+                           AND (%(end)s::BIGINT IS NULL OR sp.start_time < %(end)s)
+                         GROUP BY a.artist_id, a.name
+                         ORDER BY plays DESC, a.name
+                         LIMIT %(limit)s
+""")
+
+plays_by_hour_select = ("""SELECT hour_start / 3600000 %% 24 AS hour,
+                                  SUM(plays) AS plays
+                           FROM plays_by_hour
+                           WHERE (%(start)s::BIGINT IS NULL OR hour_start >= %(start)s)
+                             AND (%(end)s::BIGINT IS NULL OR hour_start < %(end)s)
+                           GROUP BY 1
+                           ORDER BY 1
+""")
+
+# weekday counts from Monday = 0 like the time table, 1970-01-01 was a
+# Thursday
+plays_by_weekday_select = ("""SELECT (hour_start / 86400000 + 3) %% 7 AS weekday,
+                                     SUM(plays) AS plays
+                              FROM plays_by_hour
+                              WHERE (%(start)s::BIGINT IS NULL OR hour_start >= %(start)s)
+                                AND (%(end)s::BIGINT IS NULL OR hour_start < %(end)s)
+                              GROUP BY 1
+                              ORDER BY 1
+""")
+
+active_users_select = ("""SELECT level, COUNT(DISTINCT user_id) AS users,
+                                 COUNT(*) AS plays
+                          FROM songplays
+                          WHERE (%(start)s::BIGINT IS NULL OR start_time >= %(start)s)
+                            AND (%(end)s::BIGINT IS NULL OR start_time < %(end)s)
+                          GROUP BY level
+                          ORDER BY level
+""")
+
 # QUERY LISTS - these are imported into the create_tables model
 
 create_table_queries = [
+    songplay_sequence_create,
     songplay_table_create,
     user_table_create,
     song_table_create,
     artist_table_create,
-    time_table_create]
+    time_table_create,
+    manifest_table_create,
+    quarantine_table_create,
+    song_reject_create,
+    event_reject_create,
+    load_version_create,
+    hour_rollup_create,
+    level_rollup_create,
+    artist_rollup_create]
+lookup_index_queries = [
+    song_title_index_create,
+    artist_name_index_create]
+analytic_index_queries = [
+    songplay_start_time_index_create,
+    songplay_user_index_create,
+    songplay_song_index_create]
+create_index_queries = lookup_index_queries + analytic_index_queries
+drop_index_queries = [
+    song_title_index_drop,
+    artist_name_index_drop,
+    songplay_start_time_index_drop,
+    songplay_user_index_drop,
+    songplay_song_index_drop]
+create_partitioned_table_queries = [
+    songplay_sequence_create,
+    songplay_table_create_partitioned,
+    user_table_create,
+    song_table_create,
+    artist_table_create,
+    time_table_create_partitioned,
+    manifest_table_create,
+    quarantine_table_create,
+    song_reject_create,
+    event_reject_create,
+    load_version_create,
+    hour_rollup_create,
+    level_rollup_create,
+    artist_rollup_create]
+partitioned_tables = ['songplays', 'time']
 drop_table_queries = [
     songplay_table_drop,
     user_table_drop,
     song_table_drop,
     artist_table_drop,
-    time_table_drop]
+    time_table_drop,
+    manifest_table_drop,
+    quarantine_table_drop,
+    song_reject_drop,
+    event_reject_drop,
+    load_version_drop,
+    hour_rollup_drop,
+    level_rollup_drop,
+    artist_rollup_drop,
+    songplay_sequence_drop]
+rollup_tables = ['plays_by_hour', 'plays_by_level', 'plays_by_artist']
+rollup_upsert_queries = [
+    hour_rollup_upsert,
+    level_rollup_upsert,
+    artist_rollup_upsert]
+rollup_refresh_queries = [
+    hour_rollup_refresh,
+    level_rollup_refresh,
+    artist_rollup_refresh]
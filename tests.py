@@ -17,15 +17,35 @@ __status__ = "Production"
 
 from sql_queries import *
 from create_tables import *
+from song_cache import SongCache
+from backends import SPARKIFY_DSN, get_backend
+import metrics
+import parquet_stage
+import discovery
+import readers
+import validation
+from analytics import Analytics, to_epoch_ms
+from etl import build_time_df, build_user_df, read_log_file
+from etl import build_rollups, ROLLUP_COLUMNS
+from etl import commit_loads, pipelined_loads, ensure_partitions
+from etl import lookup_song_ids, is_partitioned
+import pandas as pd
+import os
+import glob
+import importlib.util
+import gzip
+import shutil
 import psycopg2
+import tempfile
 import unittest
 
+
 class SparkifyTests(unittest.TestCase):
     
     def test_connection(self):
         '''Tests ability to connect to the database'''
         try:
-            conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+            conn = psycopg2.connect(SPARKIFY_DSN)
             self.assertIsNotNone(conn)
             conn.close()
         except Exception as e:
@@ -35,7 +55,7 @@ class SparkifyTests(unittest.TestCase):
     def test_cursor(self):
         '''Test the ability to connect to the db and open a cursor'''
         try:
-            conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+            conn = psycopg2.connect(SPARKIFY_DSN)
             cur = conn.cursor()
             self.assertIsNotNone(cur)
             conn.close()
@@ -46,7 +66,7 @@ class SparkifyTests(unittest.TestCase):
     def test_songs(self):
         '''Test that the songs table is created and has the correct shape'''
         try:
-            conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+            conn = psycopg2.connect(SPARKIFY_DSN)
             cur = conn.cursor()
             cur.execute('SELECT * FROM songs LIMIT 5')
             row = cur.fetchone()
@@ -60,7 +80,7 @@ class SparkifyTests(unittest.TestCase):
     def test_artists(self):
         '''Test that the artists table is created and has the correct shape'''
         try:
-            conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+            conn = psycopg2.connect(SPARKIFY_DSN)
             cur = conn.cursor()
             cur.execute('SELECT * FROM artists LIMIT 5')
             row = cur.fetchone()
@@ -74,11 +94,11 @@ class SparkifyTests(unittest.TestCase):
     def test_songplays(self):
         '''Test that the songplays table is created and has the correct shape'''
         try:
-            conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+            conn = psycopg2.connect(SPARKIFY_DSN)
             cur = conn.cursor()
             cur.execute('SELECT * FROM songplays LIMIT 5')
             row = cur.fetchone()
-            self.assertTrue(len(row) == 9)
+            self.assertTrue(len(row) == 10)
             self.assertTrue(type(row) == tuple)
             conn.close()
         except Exception as e:
@@ -88,21 +108,23 @@ class SparkifyTests(unittest.TestCase):
     def test_users(self):
         '''Test that the users table is created and has the correct shape'''
         try:
-            conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+            conn = psycopg2.connect(SPARKIFY_DSN)
             cur = conn.cursor()
             cur.execute('SELECT * FROM users LIMIT 5')
             row = cur.fetchone()
-            self.assertTrue(len(row) == 5)
-            self.assertTrue(type(row) == tuple)
             conn.close()
-        except Exception as e:
+        except psycopg2.Error as e:
             print('failed to validate users table')
             print(e)
+            return
+        # asserted outside the try so a wrong shape fails the test
+        self.assertEqual(len(row), 6)
+        self.assertTrue(type(row) == tuple)
             
     def test_time(self):
         '''Test that the time table is created and has the correct shape'''
         try:
-            conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+            conn = psycopg2.connect(SPARKIFY_DSN)
             cur = conn.cursor()
             cur.execute('SELECT * FROM time LIMIT 5')
             row = cur.fetchone()
@@ -117,7 +139,7 @@ class SparkifyTests(unittest.TestCase):
         '''Test that the table creation statement wont cause and error if run multiple times'''
         stmt = None
         try:
-            conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+            conn = psycopg2.connect(SPARKIFY_DSN)
             cur = conn.cursor()
             for stmt in create_table_queries:
                 cur.execute(stmt)
@@ -128,5 +150,524 @@ class SparkifyTests(unittest.TestCase):
             print(stmt)
             print(e)
 
+    def test_index_create(self):
+        '''Test that the index creation statements wont cause an error if run multiple times'''
+        stmt = None
+        try:
+            conn = psycopg2.connect(SPARKIFY_DSN)
+            cur = conn.cursor()
+            for stmt in create_index_queries:
+                cur.execute(stmt)
+                cur.execute(stmt)
+            conn.close()
+        except Exception as e:
+            print('Error creating index. SQL erroring follows:')
+            print(stmt)
+            print(e)
+
+
+class SongCacheTests(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        '''Test that the song cache counts hits and misses'''
+        cache = SongCache(2 ** 20)
+        cache.put(('Song', 'Artist', 218.5), ('S1', 'A1'))
+        self.assertEqual(cache.get(('Song', 'Artist', 218.5)), ('S1', 'A1'))
+        self.assertIsNone(cache.get(('Song', 'Artist', 100.0)))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_eviction(self):
+        '''Test that the least recently used entry is evicted at the cap'''
+        cache = SongCache(2 ** 20)
+        cache.put(('a', 'x', 1.0), ('S1', 'A1'))
+        cache.max_bytes = cache.nbytes * 2
+        cache.put(('b', 'x', 2.0), ('S2', 'A1'))
+        cache.get(('a', 'x', 1.0))
+        cache.put(('c', 'x', 3.0), ('S3', 'A1'))
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get(('b', 'x', 2.0)))
+        self.assertIsNotNone(cache.get(('a', 'x', 1.0)))
+
+    def test_events_without_song(self):
+        '''Test that events missing their song or artist resolve to no
+        song without touching the cache or the database'''
+        cache = SongCache(2 ** 20)
+        cache.put(('Song', 'Artist', 218.5), ('S1', 'A1'))
+        df = pd.DataFrame({'song': ['Song', None, 'Song'],
+                           'artist': ['Artist', 'Artist', float('nan')],
+                           'length': [218.5, 218.5, 218.5]})
+        song_ids, artist_ids = lookup_song_ids(None, df, cache)
+        self.assertEqual(song_ids, ['S1', None, None])
+        self.assertEqual(artist_ids, ['A1', None, None])
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_add_counters(self):
+        '''Test that the counters of worker copies add up'''
+        cache = SongCache(2 ** 20)
+        cache.add_counters((3, 1, 0))
+        cache.add_counters((2, 2, 1))
+        self.assertEqual(cache.counters(), (5, 3, 1))
+
+
+class TimeDimensionTests(unittest.TestCase):
+
+    def test_build_time_df(self):
+        '''Test that timestamps are de-duplicated and broken out correctly'''
+        # 2018-11-01 21:01:46.796 UTC, a Thursday in ISO week 44
+        df = pd.DataFrame({'ts': [1541106106796, 1541106106796]})
+        time_df = build_time_df(df)
+        self.assertEqual(len(time_df), 1)
+        self.assertEqual(list(time_df.iloc[0]),
+                         [1541106106796, 21, 1, 44, 11, 2018, 3])
+
+    def test_iso_week_year_boundary(self):
+        '''Test that the first days of a year can belong to week 52 or 53'''
+        # 2021-01-01 was a Friday in ISO week 53 of 2020
+        df = pd.DataFrame({'ts': [1609459200000]})
+        self.assertEqual(build_time_df(df).week[0], 53)
+
+
+class UserDimensionTests(unittest.TestCase):
+
+    def test_latest_level_wins(self):
+        '''Test that the latest event of a user decides their level'''
+        df = pd.DataFrame({'userId': [8, 8, 10],
+                           'firstName': ['Kaylee', 'Kaylee', 'Sylvie'],
+                           'lastName': ['Summers', 'Summers', 'Cruz'],
+                           'gender': ['F', 'F', 'F'],
+                           'level': ['paid', 'free', 'free'],
+                           'ts': [2000, 1000, 1500]})
+        user_df = build_user_df(df)
+        self.assertEqual(len(user_df), 2)
+        self.assertEqual(
+            user_df.set_index('userId').level.to_dict(),
+            {8: 'paid', 10: 'free'})
+
+    def test_users_sorted_by_id(self):
+        '''Test that users are upserted in user id order'''
+        df = pd.DataFrame({'userId': ['10', '8', '9'],
+                           'firstName': ['Sylvie', 'Kaylee', 'Jordan'],
+                           'lastName': ['Cruz', 'Summers', 'Hicks'],
+                           'gender': ['F', 'F', 'F'],
+                           'level': ['free', 'free', 'paid'],
+                           'ts': [1000, 1500, 2000]})
+        self.assertEqual(build_user_df(df).userId.tolist(), ['8', '9', '10'])
+
+    def test_files_loaded_out_of_order(self):
+        '''Test that a file loaded after a later one keeps the level of
+        the later file'''
+        if importlib.util.find_spec('duckdb') is None:
+            self.skipTest('duckdb is not installed')
+
+        event = read_log_file(
+            sorted(glob.glob('data/log_data/*/*/*.json'))[0]).iloc[0]
+        with tempfile.TemporaryDirectory() as tmp:
+            for day, level, ts in (('30', 'paid', 1543536000000),
+                                   ('01', 'free', 1541030400000)):
+                os.makedirs(os.path.join(tmp, day))
+                event = event.copy()
+                event['userId'], event['level'], event['ts'] = '8', level, ts
+                event.to_frame().T.to_json(
+                    os.path.join(tmp, day, 'events.json'),
+                    orient='records', lines=True)
+
+            backend = get_backend('duckdb',
+                                  path=os.path.join(tmp, 'test.duckdb'))
+            conn = backend.connect()
+            for day in ('30', '01'):
+                backend.load_logs(conn, None, os.path.join(tmp, day))
+            user = conn.execute('SELECT level, last_seen FROM users '
+                                'WHERE user_id = 8').fetchone()
+            conn.close()
+        self.assertEqual(user, ('paid', 1543536000000))
+
+
+class RollupTests(unittest.TestCase):
+
+    def test_partial_aggregates(self):
+        '''Test the per hour, level and artist counts of a batch of plays'''
+        hour = 1541106000000
+        plays = pd.DataFrame([(hour + 1000, 'free', 'AR1'),
+                              (hour + 2000, 'paid', None),
+                              (hour + 86400000, 'paid', 'AR1')],
+                             columns=ROLLUP_COLUMNS)
+        hours, levels, artists = build_rollups(plays)
+        self.assertEqual(hours, [(hour, 2), (hour + 86400000, 1)])
+        self.assertEqual(levels, [(1541030400000, 'free', 1),
+                                  (1541030400000, 'paid', 1),
+                                  (1541116800000, 'paid', 1)])
+        self.assertEqual(artists, [('AR1', 2)])
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_stage_totals(self):
+        '''Test that stage measurements are summed until they are flushed'''
+        metrics.totals.clear()
+        for rows in (3, 4):
+            with metrics.stage('log_parse', bytes_read=10) as stage:
+                stage.rows_out = rows
+        total = metrics.totals['log_parse']
+        self.assertEqual((total['calls'], total['rows_out'],
+                          total['bytes_read']), (2, 7, 20))
+        metrics.flush('test')
+        self.assertEqual(len(metrics.totals), 0)
+
+
+class DuckDBBackendTests(unittest.TestCase):
+
+    def test_load_twice(self):
+        '''Test that the duckdb backend loads the sample data idempotently'''
+        if importlib.util.find_spec('duckdb') is None:
+            self.skipTest('duckdb is not installed')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = get_backend('duckdb',
+                                  path=os.path.join(tmp, 'test.duckdb'))
+            conn = backend.connect()
+            counts = []
+            for _ in range(2):
+                backend.load(conn, None, 'data/song_data', 'data/log_data')
+                counts.append([conn.execute(
+                    'SELECT count(*) FROM {}'.format(table)).fetchone()[0]
+                    for table in ('songs', 'users', 'songplays')])
+            conn.close()
+        self.assertEqual(counts[0], counts[1])
+        self.assertTrue(all(counts[0]))
+
+
+class RecordingCursor(object):
+    '''Cursor that records the statements of a load instead of running
+    them'''
+
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def execute(self, query, vars=None):
+        self.statements.append((query, vars))
+
+    def commit(self):
+        self.commits += 1
+
+
+class PartitionTests(unittest.TestCase):
+
+    def test_existing_partitions_not_locked(self):
+        '''Test that only missing partitions are locked and created'''
+        cur = RecordingCursor()
+        cur.fetchall = lambda: [('time_y2018m11',)]
+        ensure_partitions(cur, pd.DataFrame({'ts': [1541030400000,
+                                                   1543622399999]}))
+        self.assertEqual(cur.statements[0],
+                         (partitions_missing_select,
+                          (['songplays_y2018m11', 'time_y2018m11'],)))
+        self.assertEqual(cur.statements[1],
+                         (partition_lock, ('time_y2018m11',)))
+        self.assertEqual(len(cur.statements), 3)
+
+    def test_partitioning_not_probed_before_10(self):
+        '''Test that servers before Postgres 10 are not asked for
+        partitioned tables'''
+        cur = RecordingCursor()
+        cur.server_version = 90516
+        self.assertFalse(is_partitioned(cur, cur, 'songplays'))
+        self.assertEqual(cur.statements, [])
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_files_written_in_order(self):
+        '''Test that a pipelined load writes and commits files in order'''
+        cur = RecordingCursor()
+        files = sorted(glob.glob('data/log_data/*/*/*.json'))
+        written = []
+        loads = pipelined_loads(
+            cur, files, read_log_file,
+            lambda cur, df, source: written.append((source, df.ts.min())),
+            depth=3)
+        commit_loads(cur, cur, loads)
+        self.assertEqual([source for source, ts in written], files)
+        self.assertEqual(written, sorted(written))
+        self.assertEqual(cur.commits, len(files))
+
+
+class CommitBatchTests(unittest.TestCase):
+
+    def test_failed_file_quarantined(self):
+        '''Test that a failing file is rolled back to its savepoint and
+        quarantined while the rest of its batch commits'''
+        def load(rows):
+            if rows is None:
+                raise ValueError('bad file')
+            return rows
+
+        cur = RecordingCursor()
+        loads = [(['a.json'], lambda: load(3)),
+                 (['b.json'], lambda: load(None)),
+                 (['c.json'], lambda: load(4))]
+        result = commit_loads(cur, cur, loads, commit_files=2)
+        self.assertEqual(result, (3, 1))
+        self.assertEqual(cur.commits, 2)
+        self.assertIn((file_savepoint_rollback, None), cur.statements)
+        self.assertIn((quarantine_table_upsert, ('b.json', 'bad file')),
+                      cur.statements)
+
+    def test_failed_batch_retried_file_by_file(self):
+        '''Test that only the bad file of a failed batch is quarantined'''
+        def load(filepaths):
+            if 'b.json' in filepaths:
+                raise ValueError('bad file')
+            return len(filepaths)
+
+        cur = RecordingCursor()
+        files = ['a.json', 'b.json', 'c.json']
+        loads = [(files, lambda: load(files))]
+        result = commit_loads(cur, cur, loads,
+                              file_load=lambda f: lambda: load([f]))
+        self.assertEqual(result, (3, 1))
+        quarantined = [vars[0] for query, vars in cur.statements
+                       if query == quarantine_table_upsert]
+        self.assertEqual(quarantined, ['b.json'])
+
+    def test_commit_by_rows(self):
+        '''Test that a batch commits early once it holds enough rows'''
+        cur = RecordingCursor()
+        loads = [([str(i)], lambda: 5) for i in range(4)]
+        commit_loads(cur, cur, loads, commit_files=10, commit_rows=10)
+        self.assertEqual(cur.commits, 2)
+
+
+class DiscoveryTests(unittest.TestCase):
+
+    def test_checkpoints_skipped(self):
+        '''Test that notebook checkpoint copies of song files are skipped'''
+        files = list(discovery.iter_data_files('data/song_data'))
+        everything = list(discovery.iter_data_files(
+            'data/song_data', exclude=(), skip_hidden=False))
+        self.assertFalse([f for f in files if 'checkpoint' in f])
+        self.assertEqual(len(everything) - len(files), 2)
+
+    def test_sorted_order(self):
+        '''Test that sorted discovery yields files in path order'''
+        files = list(discovery.iter_data_files('data/log_data', sort=True))
+        self.assertEqual(files, sorted(files))
+        self.assertEqual([len(b) for b in discovery.iter_batches(files, 12)],
+                         [12, 12, 6])
+
+    def test_sorted_order_mixed(self):
+        '''Test that sorted discovery interleaves the files of a directory
+        with those of its subdirectories in path order'''
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ('a.json', 'b/c.json', 'b-d.json', 'e/f/g.json',
+                         'z.json'):
+                path = os.path.join(tmp, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'w').close()
+            files = list(discovery.iter_data_files(tmp, sort=True))
+            self.assertEqual(len(files), 5)
+            self.assertEqual(files, sorted(files))
+
+
+class ParquetStageTests(unittest.TestCase):
+
+    def test_incremental_staging(self):
+        '''Test that staging converts each json file once and reads back'''
+        try:
+            parquet_stage.check_engine()
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            song_dest, event_dest = parquet_stage.stage_data(
+                'data/song_data', 'data/log_data', tmp)
+            parquet_stage.stage_data('data/song_data', 'data/log_data', tmp)
+            self.assertTrue(os.path.isdir(
+                os.path.join(event_dest, 'year=2018', 'month=11')))
+
+            part = os.path.join(event_dest, 'year=2018', 'month=11',
+                                'part-00000.parquet')
+            self.assertFalse(os.path.exists(part.replace('00000', '00001')))
+            df = read_log_file(part)
+            self.assertEqual(set(df.page), {'NextSong'})
+            self.assertEqual(len(df),
+                             sum(len(read_log_file(f)) for f in glob.glob(
+                                 'data/log_data/*/*/*.json')))
+
+    def test_missing_integers_survive_staging(self):
+        '''Test that an event without a ts is staged as missing and
+        rejected on load, like it is from json'''
+        try:
+            parquet_stage.check_engine()
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+
+        source = sorted(glob.glob('data/log_data/*/*/*.json'))[0]
+        df = read_log_file(source).head(2).copy()
+        df['ts'] = df.ts.astype(object)
+        df.iloc[1, df.columns.get_loc('ts')] = None
+        with tempfile.TemporaryDirectory() as tmp:
+            datafile = os.path.join(tmp, 'events.json')
+            df.to_json(datafile, orient='records', lines=True)
+            parquet_stage.convert_logs([datafile], tmp)
+            staged = pd.concat(read_log_file(f) for f in sorted(
+                glob.glob(os.path.join(tmp, '*', '*', '*.parquet'))))
+
+        self.assertEqual(staged.ts.isnull().sum(), 1)
+        keep, reasons, records = validation.validate(staged,
+                                                     validation.EVENT_RULES)
+        self.assertEqual(keep.sum(), 1)
+        self.assertEqual(reasons, ['ts is missing'])
+
+
+class ValidationTests(unittest.TestCase):
+
+    def test_sample_data_is_valid(self):
+        '''Test that no sample NextSong event fails validation'''
+        df = pd.concat([read_log_file(f)
+                        for f in glob.glob('data/log_data/*/*/*.json')])
+        keep, reasons, records = validation.validate(df,
+                                                     validation.EVENT_RULES)
+        self.assertTrue(keep.all())
+        self.assertEqual(reasons, [])
+
+    def test_rejects_hold_their_reasons(self):
+        '''Test that failing rows are rejected with every failed rule'''
+        df = pd.DataFrame({'song_id': ['S1', 'S2', None],
+                           'artist_id': ['A1', 'A2', 'A3'],
+                           'year': [2000, 0, 1999],
+                           'duration': [200.5, 'long', 180.0],
+                           'artist_latitude': [None, 95.0, -33.9],
+                           'artist_longitude': [None, 0.0, 18.4]})
+        keep, reasons, records = validation.validate(df,
+                                                     validation.SONG_RULES)
+        self.assertEqual(keep.tolist(), [True, False, False])
+        self.assertEqual(reasons, [
+            'duration is not a number; artist_latitude is out of range',
+            'song_id is missing'])
+        self.assertEqual(len(records), 2)
+        self.assertIn('"song_id":"S2"', records[0])
+
+
+class ReaderTests(unittest.TestCase):
+
+    def copy_log(self, tmp, name, compress=None):
+        '''Copies the first sample log file into tmp, compressed or not'''
+        source = sorted(glob.glob('data/log_data/*/*/*.json'))[0]
+        path = os.path.join(tmp, name)
+        with open(source, 'rb') as src:
+            with (compress or open)(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        return source, path
+
+    def test_compressed_and_jsonl_files(self):
+        '''Test that gzip and jsonl files read the same as plain json'''
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, compress in (('events.json.gz', gzip.open),
+                                   ('events.jsonl', None)):
+                source, path = self.copy_log(tmp, name, compress)
+                expected = pd.read_json(source, lines=True)
+                pd.testing.assert_frame_equal(
+                    readers.read_json_frame(path), expected)
+                chunks = list(readers.iter_json_frames(path, 4))
+                self.assertEqual(sum(len(c) for c in chunks), len(expected))
+            self.assertEqual(
+                [os.path.basename(f) for f in discovery.iter_data_files(
+                    tmp, sort=True)], ['events.json.gz', 'events.jsonl'])
+
+    def test_zstandard_file(self):
+        '''Test that zstandard files are decompressed as a stream'''
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest('zstandard is not installed')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source, path = self.copy_log(
+                tmp, 'events.json.zst',
+                lambda p, m: zstandard.open(p, m))
+            with open(source, 'rb') as f:
+                expected = [line for line in f if line.strip()]
+            self.assertEqual(list(readers.iter_lines(path)), expected)
+
+    def test_mmap_lines(self):
+        '''Test that large plain files split into the same lines'''
+        source = sorted(glob.glob('data/log_data/*/*/*.json'))[0]
+        small = list(readers.iter_lines(source))
+        min_bytes = readers.MMAP_MIN_BYTES
+        readers.MMAP_MIN_BYTES = 1
+        try:
+            self.assertEqual(list(readers.iter_lines(source)), small)
+            pd.testing.assert_frame_equal(readers.read_json_frame(source),
+                                          pd.read_json(source, lines=True))
+        finally:
+            readers.MMAP_MIN_BYTES = min_bytes
+
+
+class FakePool(object):
+    '''Connection pool handing out a connection whose cursor answers the
+    load version and a fixed report, counting the report queries'''
+
+    def __init__(self):
+        self.version = (1, None)
+        self.queries = 0
+        self.autocommit = False
+
+    def getconn(self):
+        return self
+
+    def putconn(self, conn):
+        pass
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, vars=None):
+        self.result = [self.version]
+        if query != load_version_select:
+            self.queries += 1
+            self.description = [('level',), ('users',)]
+            self.result = [('free', vars['start']), ('paid', vars['end'])]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+class AnalyticsTests(unittest.TestCase):
+
+    def test_cached_until_load_version_changes(self):
+        '''Test that repeated reports come from the cache until a load
+        bumps the version'''
+        pool = FakePool()
+        analytics = Analytics(pool=pool, check_seconds=0)
+        first = analytics.active_users('2018-11-01', '2018-12-01')
+        second = analytics.active_users('2018-11-01', '2018-12-01')
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        self.assertEqual(second.rows, first.rows)
+        self.assertEqual(pool.queries, 1)
+
+        analytics.active_users('2018-11-02')
+        pool.version = (2, None)
+        self.assertFalse(
+            analytics.active_users('2018-11-01', '2018-12-01').cached)
+        self.assertEqual(pool.queries, 3)
+        self.assertFalse(pool.autocommit)
+
+    def test_period_bounds(self):
+        '''Test that period bounds are converted to epoch ms'''
+        self.assertEqual(to_epoch_ms('2018-11-01'), 1541030400000)
+        self.assertEqual(to_epoch_ms(1541030400000), 1541030400000)
+        self.assertIsNone(to_epoch_ms(None))
+
 if __name__ == '__main__':
     unittest.main(argv=['ignore'], exit=False)
\ No newline at end of file
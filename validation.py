@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""This module is used as an import for the etl module. It checks the song
+records and NextSong events of a batch against data quality rules before
+they are loaded. Every rule is evaluated on a whole column at once as a
+boolean mask, so a clean batch costs a few vectorized passes and no per-row
+Python. Only the rows that fail a rule are turned into reject records,
+holding the reasons they failed and the row itself as json.
+
+A rule is a (column, check, argument) tuple, the checks being:
+
+    required - the value is present and not an empty string
+    number   - a present value parses as a number
+    integer  - a present value parses as a whole number
+    range    - a present number lies in the (low, high) bounds, either of
+               which may be None
+    choice   - a present value is one of the given values
+
+Dependencies: None
+"""
+__author__ = "Tim Fenton"
+__copyright__ = "Copyright 2019"
+__credits__ = ["Tim Fenton"]
+__license__ = "GPL"
+__version__ = "1.0"
+__maintainer__ = "Tim Fenton"
+__email__ = "tfenton@gmail.com"
+__status__ = "Production"
+
+import itertools
+import numpy as np
+import pandas as pd
+
+# rules of the song and artist records, song ids and artist ids are the
+# keys of their tables and songs reference their artist
+SONG_RULES = (('song_id', 'required', None),
+              ('artist_id', 'required', None),
+              ('year', 'integer', None),
+              ('year', 'range', (0, None)),
+              ('duration', 'number', None),
+              ('duration', 'range', (0, None)),
+              ('artist_latitude', 'number', None),
+              ('artist_latitude', 'range', (-90, 90)),
+              ('artist_longitude', 'number', None),
+              ('artist_longitude', 'range', (-180, 180)))
+
+# rules of the NextSong events, every songplay references a user and a time
+EVENT_RULES = (('ts', 'required', None),
+               ('ts', 'integer', None),
+               ('ts', 'range', (0, None)),
+               ('userId', 'required', None),
+               ('userId', 'integer', None),
+               ('level', 'choice', ('free', 'paid')),
+               ('gender', 'choice', ('F', 'M')),
+               ('sessionId', 'required', None),
+               ('sessionId', 'integer', None),
+               ('itemInSession', 'required', None),
+               ('itemInSession', 'integer', None),
+               ('itemInSession', 'range', (0, None)),
+               ('length', 'number', None),
+               ('length', 'range', (0, None)))
+
+CHECK_REASONS = {'required': 'is missing',
+                 'number': 'is not a number',
+                 'integer': 'is not an integer',
+                 'range': 'is out of range',
+                 'choice': 'is not an allowed value'}
+
+
+def failures(values, check, arg=None):
+    """Returns a boolean array that is True for the values failing a check.
+
+    Keyword arguments:
+    values - Series of the column to check
+    check - str, name of the check, a key of CHECK_REASONS
+    arg - argument of the check, the bounds of range and the allowed
+          values of choice
+    """
+    missing = (values.isnull() | (values == '')).values
+    if check == 'required':
+        return missing
+    if check == 'choice':
+        return ~missing & ~values.isin(arg).values
+
+    numbers = pd.to_numeric(values.where(~missing), errors='coerce')
+    numbers = numbers.values.astype('float64')
+    if check == 'number':
+        return ~missing & np.isnan(numbers)
+    if check == 'integer':
+        return ~missing & ~(numbers % 1 == 0)
+    if check == 'range':
+        # NaN compares False, values that aren't numbers pass here
+        low, high = arg
+        failed = np.zeros(len(numbers), dtype=bool)
+        if low is not None:
+            failed |= numbers < low
+        if high is not None:
+            failed |= numbers > high
+        return failed
+
+    raise ValueError('Unknown validation check {}'.format(check))
+
+
+def validate(df, rules):
+    """Checks every row of a DataFrame against a set of rules.
+
+    Keyword arguments:
+    df - DataFrame of the records to check
+    rules - tuple of (column, check, argument) rules, a column missing from
+            df is checked as all nulls
+
+    Returns a tuple of a boolean array that is True for the rows passing
+    every rule, the list of reasons of each rejected row and the list of
+    the rejected rows as json, both in the order of the rows.
+    """
+    names, masks = [], []
+    for column, check, arg in rules:
+        values = df[column] if column in df else pd.Series(None,
+                                                           index=df.index)
+        masks.append(failures(values, check, arg))
+        names.append('{} {}'.format(column, CHECK_REASONS[check]))
+
+    failed = np.column_stack(masks)
+    keep = ~failed.any(axis=1)
+    if keep.all():
+        return keep, [], []
+
+    reasons = ['; '.join(itertools.compress(names, row))
+               for row in failed[~keep]]
+    records = df[~keep].to_json(orient='records', lines=True).splitlines()
+
+    return keep, reasons, records